@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Creole to HTML time, previous vs current parser.
+
+Converts the samples below repeated to make large documents, and many
+short snippets, or the given files, with the CreoleParser and with a copy
+working the way it used to (dispatching each match through groupdict(),
+matching plain text one character at a time, compiling its block rules
+once the re module cache lost them):
+
+    python benchmarks/bench_creole.py [--repeat-sample 500] [file.creole...]
+"""
+from __future__ import unicode_literals
+
+import argparse
+import io
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from creole.emitter.creol2html_emitter import HtmlEmitter
+from creole.parser.creol2html_parser import CreoleParser
+from creole.parser.creol2html_rules import BlockRules, INLINE_FLAGS, \
+    INLINE_RULES, InlineRules
+from creole.shared.document_tree import DocNode
+
+SAMPLE = """= Results of the race =
+== Stage //one// ==
+A paragraph with **strong**, //emphasis//, ##mono##, ^^sup^^, ,,sub,,,
+__under__ and --small-- text, a forced\\\\break and an escaped ~** star.
+A raw url http://example.com/page?x=1 and [[http://example.org|a link]],
+{{/images/finish.jpg|the finish}} and {{{inline pre}}}.
+
+----
+* first rider
+* second **rider**
+** with a //note//
+# first stage
+## second stage
+|= rank |= rider |
+| 1 | [[riders/one|Rider One]] |
+| 2 | Rider Two |
+
+{{{
+#!python
+print("code")
+}}}
+Line one
+line two
+line three of a long paragraph, the kind of plain text most of a document
+is made of, between the few places where the markup is.
+
+"""
+
+
+PROSE = """The race started under the rain, and the riders stayed together for
+most of the first lap, waiting for the climb to make the difference. On the
+second lap three of them went away, and the group let them go: the wind on
+the plateau was strong enough to bring them back before the finish, or so
+everybody thought. They kept a minute until the last kilometers, where the
+strongest of them went alone and won with a few seconds to spare, while the
+group was sprinting for the places.
+
+"""
+
+SNIPPET = """**Next race:** sunday, see [[calendar|the calendar]]."""
+
+
+class PreviousParser(CreoleParser):
+    """CreoleParser as it was before the handler table and the plain text
+    runs
+    """
+    inline_re = re.compile('|'.join(
+        rule for rule in INLINE_RULES if rule is not InlineRules.plain
+    ), INLINE_FLAGS)
+    link_re = re.compile(
+        '|'.join([InlineRules.image, InlineRules.linebreak, InlineRules.char]),
+        re.VERBOSE | re.UNICODE
+    )
+
+    def __init__(self, raw, block_rules=None, blog_line_breaks=True):
+        CreoleParser.__init__(self, raw, block_rules, blog_line_breaks)
+        # a process using more patterns than the re module cache keeps
+        re.purge()
+        if block_rules is None:
+            block_rules = BlockRules(blog_line_breaks=blog_line_breaks)
+        self.block_re = re.compile('|'.join(block_rules.rules),
+                                   block_rules.re_flags)
+
+    def _replace(self, match):
+        groups = match.groupdict()
+        for name, text in groups.items():
+            if text is not None:
+                getattr(self, '_%s_repl' % name)(match)
+                return
+
+    def _add_text(self, text):
+        if self.text is None:
+            self.text = DocNode('text', self.cur, "")
+        self.text.content += text
+
+
+def convert(parser_class, document):
+    return HtmlEmitter(parser_class(document).parse()).emit()
+
+
+def bench(parser_class, documents, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for document in documents:
+            convert(parser_class, document)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--repeat-sample', type=int, default=500,
+                        help='copies of each sample in its document')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.files:
+        runs = [(filename, [io.open(filename, encoding='utf8').read()])
+                for filename in args.files]
+    else:
+        runs = [('markup', [SAMPLE * args.repeat_sample]),
+                ('prose', [PROSE * args.repeat_sample]),
+                ('snippets', [SNIPPET] * (10 * args.repeat_sample))]
+
+    for name, documents in runs:
+        mismatches = len([document for document in documents
+                          if convert(CreoleParser, document) !=
+                          convert(PreviousParser, document)])
+        size = sum(len(document) for document in documents)
+        before = bench(PreviousParser, documents, args.repeat)
+        after = bench(CreoleParser, documents, args.repeat)
+        print('%s: %d KB, %d mismatches' % (name, size // 1024, mismatches))
+        print('  previous parser: %.1f ms' % (1000 * before))
+        print('  current parser:  %.1f ms' % (1000 * after))
+        print('  speedup:         %.2fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Per page cost of the article extraction, XPath searches vs single pass.
+
+Runs on the pages already in the download cache, nothing is downloaded:
+
+    python benchmarks/bench_extract.py [--cache pages.db] [--limit 200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webscraping import xpath
+
+from scraper.cache import PageCache
+from scraper.extract import extract_article
+
+
+def xpath_extract(url, page):
+    """The seven XPath searches scrap.py used to do on each page"""
+    title = xpath.search(page, '//a[@class="titreArticle"]')[0]
+    content = xpath.search(page, '//div[@class="contenuArticle"]')[0].strip()
+    day = int(xpath.search(page, '//span[@class="day"]')[0])
+    month = int(xpath.search(page, '//span[@class="month"]')[0][-2:])
+    year = int(xpath.search(page, '//span[@class="year"]')[0][-4:])
+    hour = xpath.search(page, '//span[@class="hour"]')[0]
+    date = '%d-%.2d-%.2d %s' % (year, month, day, hour)
+    images = xpath.search(page, '//img/@src')
+    images = [image.strip() for image in images if image in content
+              and image.strip() != '']
+    return title, date, content, images
+
+
+def cached_pages(cache_file, urls, limit):
+    cache = PageCache(cache_file)
+    pages = []
+    for url in urls:
+        try:
+            page = cache[url]
+        except KeyError:
+            continue
+        if page:
+            pages.append((url, page.decode('utf8')))
+            if len(pages) >= limit:
+                break
+    return pages
+
+
+def bench(fn, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for url, page in pages:
+            fn(url, page)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cache', default='pages.db')
+    parser.add_argument('--articles', default='articles.json')
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    with open(args.articles) as f:
+        urls = json.loads(f.read())
+    pages = cached_pages(args.cache, urls, args.limit)
+    if not pages:
+        sys.exit('No cached article page in %s' % args.cache)
+
+    mismatches = 0
+    for url, page in pages:
+        title, date, content, images = xpath_extract(url, page)
+        article = extract_article(url, page)
+        unique = []
+        for image in images:
+            if image not in unique:
+                unique.append(image)
+        if (title, date, content, unique) != (article.title, article.date,
+                                              article.content,
+                                              article.images):
+            mismatches += 1
+            print('Different result for %s' % url)
+
+    before = bench(xpath_extract, pages, args.repeat)
+    after = bench(extract_article, pages, args.repeat)
+    print('%d pages, %d mismatches' % (len(pages), mismatches))
+    print('xpath searches: %.2f ms/page' % (1000 * before / len(pages)))
+    print('single pass:    %.2f ms/page' % (1000 * after / len(pages)))
+    print('speedup:        %.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
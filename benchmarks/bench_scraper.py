@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Throughput and per stage latency of the scraper against a replay server.
+
+Nothing goes to the real blog: the pages and images come from the replay
+server (see replay.py), either generated or recorded by a previous run,
+with the latency and error rate given on the command line. The scraper
+runs in a temporary directory, first end to end (scrap.main), then stage
+by stage to time each of them on its own:
+
+    python benchmarks/bench_scraper.py --synthetic 500 --latency 50
+    python benchmarks/bench_scraper.py --recording pages.db --error-rate 0.02
+"""
+import argparse
+import contextlib
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrap
+from replay import ReplayServer, add_arguments, build_site, server_options
+from scraper.cache import PageCache
+from scraper.convert import render
+from scraper.extract import extract_article
+from scraper.fetch import PageFetcher
+from scraper.images import ImageDownloader
+from scraper.listing import list_articles
+from scraper.metrics import Metrics
+from scraper.store import ImageStore
+
+
+@contextlib.contextmanager
+def workdir():
+    """Run in a new temporary directory, silencing the scraper output"""
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    path = tempfile.mkdtemp(prefix='bench-scraper-')
+    os.chdir(path)
+    for name in ('archives', scrap.image_dir):
+        os.mkdir(name)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield path
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(path)
+
+
+def end_to_end(args):
+    """Run the whole scraper, return the number of articles written and
+    the elapsed time
+    """
+    with workdir():
+        start = time.time()
+        scrap.main(['--delay', '0', '--workers', str(args.workers),
+                    '--image-workers', str(args.image_workers),
+                    '--image-rate', str(args.image_rate),
+                    '--list-workers', str(args.list_workers)] +
+                   (['--convert-workers', str(args.convert_workers)]
+                    if args.convert_workers is not None else []))
+        elapsed = time.time() - start
+        return len(os.listdir('archives')), elapsed
+
+
+def stage_by_stage(args, metrics):
+    """Run each stage to completion before the next one, timing each call
+    """
+    with workdir():
+        cache = PageCache('pages.db')
+        fetcher = PageFetcher(num_workers=args.list_workers, cache=cache,
+                              num_retries=3, delay=0, metrics=metrics,
+                              stage='listing')
+        urls = list_articles(fetcher, scrap.DOMAIN, scrap.root, scrap.years)
+
+        fetcher = PageFetcher(num_workers=args.workers, cache=cache,
+                              num_retries=3, delay=0, metrics=metrics)
+        pages = [(url, page) for url, page in fetcher.imap(urls) if page]
+
+        records = []
+        for url, page in pages:
+            with metrics.time('extract'):
+                try:
+                    records.append(extract_article(url, page.decode('utf8')))
+                except ValueError:
+                    pass
+
+        store = ImageStore(scrap.image_dir)
+        with ImageDownloader(store, num_workers=args.image_workers,
+                             rate=args.image_rate or None, retry_delay=0.1,
+                             metrics=metrics) as downloader:
+            for record in records:
+                for image in record.images:
+                    downloader.submit(image)
+
+        scraper = scrap.Scraper(None, store, None, None, None)
+        for record in records:
+            with metrics.time('convert'):
+                page = render(record)
+            name = scrap.slugify(record.date + '-' + record.title) + '.rst'
+            with metrics.time('write'):
+                scraper.write(os.path.join('archives', name), page)
+    return len(urls), len(records)
+
+
+def serve(server):
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--image-workers', type=int, default=4)
+    parser.add_argument('--image-rate', type=float, default=0,
+                        help='requests per second to one image host, 0 for '
+                             'no limit')
+    parser.add_argument('--list-workers', type=int, default=8)
+    parser.add_argument('--convert-workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    site, _ = build_site(args, scrap.DOMAIN, scrap.root, scrap.years)
+    server = ReplayServer(site, **server_options(args))
+    # serve from another process, so that the server does not compete with
+    # the scraper for the interpreter, and is not in its memory figures
+    process = multiprocessing.Process(target=serve, args=(server,))
+    process.daemon = True
+    process.start()
+    server.socket.close()
+    os.environ['http_proxy'] = server.url
+    print('Replaying %d URLs on %s, %.0f+%.0f ms latency, %.1f%% errors' % (
+        len(site), server.url, args.latency, args.jitter,
+        100 * args.error_rate))
+    del site
+
+    try:
+        num_written, elapsed = end_to_end(args)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        metrics = Metrics()
+        num_urls, num_extracted = stage_by_stage(args, metrics)
+    finally:
+        process.terminate()
+
+    print('End to end: %d articles written in %.2fs, %.1f articles/s' % (
+        num_written, elapsed, num_written / elapsed if elapsed else 0.0))
+    # ru_maxrss is in KB on Linux
+    print('Peak RSS of the scraper process: %.1f MB' % (peak_rss / 1024.0))
+    print('Stage by stage: %d articles listed, %d extracted' % (
+        num_urls, num_extracted))
+    print(metrics.report())
+
+
+if __name__ == '__main__':
+    main()
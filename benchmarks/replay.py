@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the blog and the image hosts.
+
+The server answers as an HTTP proxy: with ``http_proxy`` pointing at it,
+every URL the scraper requests, whatever its host, is answered from a
+recording (the page cache and the image store of a previous run) or from a
+generated site, with configurable latency and error rate. Responses carry
+an ETag, and conditional requests get a 304 when it matches.
+
+    python benchmarks/replay.py --synthetic 500 --port 8800
+    http_proxy=http://127.0.0.1:8800 python scrap.py --delay 0
+"""
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import random
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scraper.cache import PageCache, normalize_url
+
+# smallest valid GIF, so that imghdr recognizes the generated images
+GIF = ('GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04'
+       '\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D'
+       '\x01\x00;')
+
+ARCHIVE = u"""<html><body><ul>
+%s
+</ul></body></html>"""
+
+ARCHIVE_ITEM = (u'<li class="listArticles  article_item_%s">'
+                u'<a href="%s">Article</a></li>')
+
+ARTICLE = u"""<html><head><title>%(title)s</title></head><body>
+%(sidebar)s
+<div class="article">
+<a class="titreArticle" href="%(url)s">%(title)s</a>
+<div class="date"><span class="day">%(day)d</span>
+<span class="month">/%(month).2d</span><span class="year">/%(year)d</span>
+<span class="hour">%(hour)s</span></div>
+<div class="contenuArticle">
+%(content)s
+</div>
+</div>
+%(sidebar)s
+</body></html>"""
+
+PARAGRAPH = (u'<p>Course %(n)d : bravo à <strong>tous</strong> les '
+             u'coureurs &amp; coureuses, <em>résultats</em> et '
+             u'<a href="http://example.com/%(n)d">classement</a>.</p>')
+
+
+class Site(object):
+    """URL -> response mapping served by the replay server
+
+    Bodies are either strings, or paths to a file read on each request.
+    """
+
+    def __init__(self):
+        self.responses = {}
+
+    def add(self, url, body, content_type='text/html'):
+        self.responses[normalize_url(url)] = (content_type, body)
+
+    def get(self, url):
+        response = self.responses.get(normalize_url(url))
+        if response is None:
+            return None
+        content_type, body = response
+        if isinstance(body, tuple):
+            with open(body[0], 'rb') as f:
+                body = f.read()
+        return content_type, body
+
+    def __len__(self):
+        return len(self.responses)
+
+
+def recorded_site(cache_file='pages.db', image_index='image_index.json',
+                  image_dir='images'):
+    """Site replaying the pages of a page cache and the images of a store
+    """
+    site = Site()
+    cache = PageCache(cache_file)
+    for key in cache:
+        page = cache.get(key)
+        if page:
+            site.add(key, page)
+    if os.path.exists(image_index):
+        with open(image_index) as f:
+            for url, name in json.loads(f.read()).items():
+                path = os.path.join(image_dir, name)
+                if os.path.exists(path):
+                    site.add(url, (path,), 'image/*')
+    return site
+
+
+def synthetic_site(domain, root, years, num_articles, images_per_article=3,
+                   sidebar_links=600, seed=0):
+    """Generated over-blog look-alike: archive pages listing
+    ``num_articles`` articles, each with paragraphs, images on third party
+    hosts (some shared between articles) and a large sidebar
+
+    Returns the site and the article URLs in listing order.
+    """
+    rand = random.Random(seed)
+    site = Site()
+    months = [(year, month) for year in years for month in range(1, 13)]
+    listed = dict((key, []) for key in months)
+    sidebar = u'<div class="sidebar"><ul>%s</ul></div>' % u''.join(
+        u'<li><a href="%sx%d">link %d</a> <img src="/s%d.gif"></li>'
+        % (domain, i, i, i % 20) for i in range(sidebar_links // 2))
+    for n in range(num_articles):
+        year, month = months[n % len(months)]
+        url = urlparse.urljoin(domain, 'article-%d.html' % (100000 + n))
+        listed[year, month].append(url)
+        content = []
+        for p in range(rand.randint(3, 12)):
+            content.append(PARAGRAPH % {'n': n})
+        for i in range(images_per_article):
+            if rand.random() < 0.3:
+                # smileys and logos shared by many articles
+                image = 'http://www.yatoula.com/gif/smiley%d.gif' % (i % 5)
+            else:
+                image = 'http://img.over-blog.com/%d/%d/%d.gif' % (year, n, i)
+            # same bytes for the same seed, so that a restarted server
+            # serves the same images
+            filler = hashlib.sha1('%d %s' % (seed, image)).digest()
+            site.add(image, GIF + filler * rand.randint(50, 2500),
+                     'image/gif')
+            content.insert(rand.randint(0, len(content)),
+                           u'<p><img src="%s" alt=""></p>' % image)
+        page = ARTICLE % {
+            'url': url, 'title': u'Résultats de la course n°%d' % n,
+            'day': 1 + n % 28, 'month': month, 'year': year,
+            'hour': u'%.2d:%.2d' % (n % 24, n % 60),
+            'content': u'\n'.join(content), 'sidebar': sidebar,
+        }
+        site.add(url, page.encode('utf8'))
+
+    articles = []
+    for year, month in months:
+        links = listed[year, month]
+        items = [ARCHIVE_ITEM % ('even' if i % 2 == 0 else 'odd', link)
+                 for i, link in enumerate(links)]
+        site.add(urlparse.urljoin(domain, root % (year, month)),
+                 (ARCHIVE % u'\n'.join(items)).encode('utf8'))
+        # the listing gives the even items of a page first
+        articles.extend(links[0::2] + links[1::2])
+    return site, articles
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send the headers and the body in one write, otherwise Nagle and
+    # delayed ACKs add 40 ms to each keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(server.latency + server.random.uniform(0, server.jitter))
+        url = self.path
+        if not urlparse.urlsplit(url).netloc:
+            # plain request instead of a proxy request
+            url = 'http://%s%s' % (self.headers.get('Host', ''), url)
+        host = urlparse.urlsplit(url).hostname
+        if host in server.slow_hosts:
+            time.sleep(server.slow_hosts[host])
+        if host in server.down_hosts or \
+                server.random.random() < server.error_rate:
+            self.reply(503, 'text/plain', 'replayed error')
+            return
+        response = server.site.get(url)
+        if response is None:
+            self.reply(404, 'text/plain', 'not recorded')
+            return
+        content_type, body = response
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.reply(304, content_type, '', etag)
+        else:
+            self.reply(200, content_type, body, etag)
+
+    def reply(self, code, content_type, body, etag=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        if code != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serve ``site`` on 127.0.0.1
+
+    latency:
+        seconds added to every response
+    jitter:
+        up to that many more seconds, uniformly distributed
+    error_rate:
+        probability of answering 503 instead
+    down_hosts:
+        hosts always answering 503
+    slow_hosts:
+        seconds added to the responses of these hosts
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, site, port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 seed=0, down_hosts=(), slow_hosts=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           ReplayHandler)
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.down_hosts = set(down_hosts)
+        self.slow_hosts = slow_hosts or {}
+        self.random = random.Random(seed)
+
+    def handle_error(self, request, client_address):
+        # clients closing their connection is not worth a traceback
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def add_arguments(parser):
+    parser.add_argument('--recording', metavar='CACHE',
+                        help='replay this page cache (with image_index.json '
+                             'and images/ next to it)')
+    parser.add_argument('--synthetic', type=int, default=200, metavar='N',
+                        help='generate a site of N articles (default)')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='milliseconds added to each response')
+    parser.add_argument('--jitter', type=float, default=10,
+                        help='up to that many more milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--down-host', action='append', default=[],
+                        metavar='HOST', help='always answer 503 for HOST')
+    parser.add_argument('--slow-host', action='append', default=[],
+                        metavar='HOST:SECONDS',
+                        help='delay the responses of HOST by SECONDS')
+
+
+def server_options(args):
+    """ReplayServer keyword arguments from the command line arguments"""
+    slow_hosts = {}
+    for spec in args.slow_host:
+        host, seconds = spec.rsplit(':', 1)
+        slow_hosts[host] = float(seconds)
+    return dict(latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                error_rate=args.error_rate, down_hosts=args.down_host,
+                slow_hosts=slow_hosts)
+
+
+def build_site(args, domain, root, years):
+    """Return the site described by the arguments and its articles (None
+    for a recording, whose listing is unknown)
+    """
+    if args.recording:
+        dirname = os.path.dirname(os.path.abspath(args.recording))
+        site = recorded_site(args.recording,
+                             os.path.join(dirname, 'image_index.json'),
+                             os.path.join(dirname, 'images'))
+        return site, None
+    return synthetic_site(domain, root, years, args.synthetic)
+
+
+def main(argv=None):
+    import scrap
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--port', type=int, default=8800)
+    args = parser.parse_args(argv)
+
+    site, _ = build_site(args, scrap.DOMAIN, scrap.root, scrap.years)
+    server = ReplayServer(site, args.port, **server_options(args))
+    print('Replaying %d URLs on %s' % (len(site), server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,7 @@ from creole.emitter.html2rest_emitter import ReStructuredTextEmitter
 from creole.emitter.html2textile_emitter import TextileEmitter
 from creole.parser.html_parser import HtmlParser
 from creole.py3compat import TEXT_TYPE
+from creole.shared.conversion_cache import ConversionCache
 
 
 __version__ = "1.3.1"
@@ -37,17 +38,63 @@ __api__ = "1.0" # Creole 1.0 spec - http://wikicreole.org/
 VERSION_STRING = __version__ # remove in future
 API_STRING = __api__ # remove in future
 
+# see set_conversion_cache()
+_conversion_cache = None
+
+
+def set_conversion_cache(cache):
+    """
+    Cache the results of creole2html(), html2creole() and html2rest():
+    'cache' is a ConversionCache, or None to stop caching.
+
+    >>> cache = ConversionCache(max_size=1024 * 1024)
+    >>> set_conversion_cache(cache)
+    >>> creole2html('**cached**')
+    '<p><strong>cached</strong></p>'
+    >>> creole2html('**cached**')
+    '<p><strong>cached</strong></p>'
+    >>> cache.stats()["hits"], cache.stats()["misses"]
+    (1, 1)
+    >>> set_conversion_cache(None)
+
+    Conversions with debug, verbose, stderr, parser_kwargs or
+    emitter_kwargs are never cached. The macros, unknown_emit and url_map
+    are told apart by identity: a macros module changed while cached would
+    still give the old results, clear() the cache then.
+    """
+    global _conversion_cache
+    _conversion_cache = cache
+
+
+def get_conversion_cache():
+    """ return the ConversionCache in use, None if there is none """
+    return _conversion_cache
+
+
+def _cached(kind, text, options, convert):
+    cache = _conversion_cache
+    if cache is None:
+        # disabled by another thread meanwhile
+        return convert()
+    result = cache.get(kind, text, options)
+    if result is None:
+        result = convert()
+        cache.put(kind, text, options, result)
+    return result
+
 
 def creole2html(markup_string, debug=False,
         parser_kwargs=None, emitter_kwargs=None,
         block_rules=None, blog_line_breaks=True,
-        macros=None, verbose=None, stderr=None,
+        macros=None, verbose=None, stderr=None, cache=True,
     ):
     """
     convert creole markup into html code
 
     >>> creole2html('This is **creole //markup//**!')
     '<p>This is <strong>creole <i>markup</i></strong>!</p>'
+
+    cache=False bypasses the cache set with set_conversion_cache().
     
     Info: parser_kwargs and emitter_kwargs are deprecated
     """
@@ -61,6 +108,21 @@ def creole2html(markup_string, debug=False,
         warnings.warn("parser_kwargs argument in creole2html would be removed in the future!", PendingDeprecationWarning)
         parser_kwargs2.update(parser_kwargs)
 
+    if cache and _conversion_cache is not None and not (debug
+            or verbose or stderr is not None
+            or parser_kwargs is not None or emitter_kwargs is not None):
+        if block_rules is None:
+            rules = None
+        else:
+            rules = "%s|%s" % (block_rules.re_flags, "|".join(block_rules.rules))
+        return _cached("creole2html", markup_string,
+            (bool(blog_line_breaks), macros, rules),
+            lambda: creole2html(markup_string,
+                block_rules=block_rules, blog_line_breaks=blog_line_breaks,
+                macros=macros, cache=False,
+            )
+        )
+
     # Create document tree from creole markup
     document = CreoleParser(markup_string, **parser_kwargs2).parse()
     if debug:
@@ -79,6 +141,26 @@ def creole2html(markup_string, debug=False,
     return HtmlEmitter(document, **emitter_kwargs2).emit()
 
 
+def creole2html_stream(chunks, blog_line_breaks=True,
+        macros=None, verbose=None, stderr=None,
+    ):
+    """
+    convert creole markup given in chunks (e.g. the lines of a file) into
+    html, yield the html of each block as soon as it is complete
+
+    >>> ''.join(creole2html_stream(['This is **creole ', '//markup//**!']))
+    '<p>This is <strong>creole <i>markup</i></strong>!</p>'
+
+    The html joined is the one of creole2html(), see
+    CreoleParser.feed() and HtmlEmitter.emit_stream() for the limits.
+    """
+    parser = CreoleParser("", blog_line_breaks=blog_line_breaks)
+    emitter = HtmlEmitter(parser.root,
+        macros=macros, verbose=verbose, stderr=stderr
+    )
+    return emitter.emit_stream(parser.iter_blocks(chunks))
+
+
 def parse_html(html_string, debug=False):
     """ create the document tree from html code """
     assert isinstance(html_string, TEXT_TYPE), "given html_string must be unicode!"
@@ -92,17 +174,27 @@ def parse_html(html_string, debug=False):
 
 def html2creole(html_string, debug=False,
         parser_kwargs=None, emitter_kwargs=None,
-        unknown_emit=None
+        unknown_emit=None, cache=True
     ):
     """
     convert html code into creole markup
 
     >>> html2creole('<p>This is <strong>creole <i>markup</i></strong>!</p>')
     'This is **creole //markup//**!'
+
+    cache=False bypasses the cache set with set_conversion_cache().
     """
     if parser_kwargs is not None:
         warnings.warn("parser_kwargs argument in html2creole would be removed in the future!", PendingDeprecationWarning)
 
+    if cache and _conversion_cache is not None and not (debug
+            or parser_kwargs is not None or emitter_kwargs is not None):
+        return _cached("html2creole", html_string, (unknown_emit,),
+            lambda: html2creole(html_string,
+                unknown_emit=unknown_emit, cache=False
+            )
+        )
+
     document_tree = parse_html(html_string, debug=debug)
 
     emitter_kwargs2 = {
@@ -146,21 +238,37 @@ def html2textile(html_string, debug=False,
 
 def html2rest(html_string, debug=False,
         parser_kwargs=None, emitter_kwargs=None,
-        unknown_emit=None
+        unknown_emit=None, url_map=None, cache=True
     ):
     """
     convert html code into ReStructuredText markup
     
     >>> html2rest('<p>This is <strong>ReStructuredText</strong> <em>markup</em>!</p>')
     'This is **ReStructuredText** *markup*!'
+
+    url_map is called with the url of each link and image:
+
+    >>> html2rest('<p><img src="/a.png" alt="A"/></p>', url_map=lambda url: "/mirror" + url)
+    '\\n|A|\\n\\n.. |A| image:: /mirror/a.png'
+
+    cache=False bypasses the cache set with set_conversion_cache().
     """
     if parser_kwargs is not None:
         warnings.warn("parser_kwargs argument in html2rest would be removed in the future!", PendingDeprecationWarning)
 
+    if cache and _conversion_cache is not None and not (debug
+            or parser_kwargs is not None or emitter_kwargs is not None):
+        return _cached("html2rest", html_string, (unknown_emit, url_map),
+            lambda: html2rest(html_string,
+                unknown_emit=unknown_emit, url_map=url_map, cache=False
+            )
+        )
+
     document_tree = parse_html(html_string, debug=debug)
 
     emitter_kwargs2 = {
         "unknown_emit": unknown_emit,
+        "url_map": url_map,
     }
     if emitter_kwargs is not None:
         warnings.warn("emitter_kwargs argument in html2rest would be removed in the future!", PendingDeprecationWarning)
@@ -119,18 +119,7 @@ class HtmlEmitter(object):
             # The document has no <<toc>>
             self.toc = None
         else:
-            if isinstance(self.macros, dict):
-                if "toc" in self.macros:
-                    self.toc = self.macros["toc"]
-                else:
-                    self.toc = TableOfContent()
-                    self.macros["toc"] = self.toc
-            else:
-                try:
-                    self.toc = getattr(self.macros, "toc")
-                except AttributeError:
-                    self.toc = TableOfContent()
-                    self.macros.toc = self.toc
+            self.setup_toc()
 
 
         if verbose is None:
@@ -143,6 +132,21 @@ class HtmlEmitter(object):
         else:
             self.stderr = stderr
 
+    def setup_toc(self):
+        """Use the toc macro given, or a TableOfContent"""
+        if isinstance(self.macros, dict):
+            if "toc" in self.macros:
+                self.toc = self.macros["toc"]
+            else:
+                self.toc = TableOfContent()
+                self.macros["toc"] = self.toc
+        else:
+            try:
+                self.toc = getattr(self.macros, "toc")
+            except AttributeError:
+                self.toc = TableOfContent()
+                self.macros.toc = self.toc
+
     def get_text(self, node):
         """Try to emit whatever text is in the node."""
         try:
@@ -399,6 +403,42 @@ class HtmlEmitter(object):
         else:
             return document
 
+    def emit_stream(self, nodes):
+        """
+        Emit the top level nodes as they come, e.g. from
+        CreoleParser.iter_blocks() on self.root, yield their html.
+
+        Joined, the html is the one emit() returns for the whole document.
+        Except that a <<toc>> needs the whole document: the html is kept
+        from the block with the <<toc>> to the end, and the headlines
+        emitted before it are neither in the table nor anchored.
+        """
+        held = None # html kept for the toc
+        pending = "" # whitespace, dropped at the end like emit() strips it
+        started = False
+        for node in nodes:
+            if self.toc is None and "toc" in self.root.used_macros:
+                self.setup_toc()
+                held = []
+            html = self.emit_node(node)
+            if held is not None:
+                held.append(html)
+                continue
+            if not started:
+                html = html.lstrip()
+                started = bool(html)
+            text = html.rstrip()
+            if text:
+                yield pending + text
+                pending = html[len(text):]
+            else:
+                pending += html
+        if held is not None:
+            document = pending + "".join(held)
+            if not started:
+                document = document.lstrip()
+            yield self.toc.emit(document.rstrip())
+
     def error(self, text, exc_info=None):
         """
         Error Handling.
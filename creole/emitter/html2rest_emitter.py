@@ -32,8 +32,12 @@ class ReStructuredTextEmitter(BaseEmitter):
     """
     Build from a document_tree (html2creole.parser.HtmlParser instance) a
     creole markup text.
+
+    url_map is an optional callable, applied to the url of every link and
+    image before it is emitted (e.g. to point them to a local mirror).
     """
     def __init__(self, *args, **kwargs):
+        self.url_map = kwargs.pop("url_map", None)
         super(ReStructuredTextEmitter, self).__init__(*args, **kwargs)
 
         self.table_head_prefix = "_. "
@@ -226,6 +230,11 @@ class ReStructuredTextEmitter(BaseEmitter):
                 ) % (text, old_url, url)
                 raise Html2restException(msg)
 
+    def _map_url(self, url):
+        if self.url_map is None:
+            return url
+        return self.url_map(url)
+
     def a_emit(self, node):
         link_text = self.emit_children(node)
         link_text = link_text.strip()
@@ -239,7 +248,7 @@ class ReStructuredTextEmitter(BaseEmitter):
         if link_text.startswith('**') and link_text.endswith('**'):
             link_text = link_text[2:-1]
 
-        url = node.attrs["href"]
+        url = self._map_url(node.attrs["href"])
         if url.startswith('http://assets.acr-dijon'):
             return self.img_emit(node.children[0])
 
@@ -274,7 +283,7 @@ class ReStructuredTextEmitter(BaseEmitter):
     def img_emit(self, node):
         if 'src' not in node.attrs:
             return ''
-        src = node.attrs["src"]
+        src = self._map_url(node.attrs["src"])
 
         if src.split(':')[0] == 'data':
             return ""
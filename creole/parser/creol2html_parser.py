@@ -32,6 +32,38 @@ from creole.py3compat import TEXT_TYPE
 from creole.shared.document_tree import DocNode
 
 
+# The compiled block rules, shared by all parsers: the block rules make a
+# large regexp, and in a process using many patterns the re module cache
+# does not keep it. Keyed by blog_line_breaks for the default rules, by
+# rules and flags for the block_rules given.
+BLOCK_RE_CACHE_SIZE = 100
+_block_re_cache = {}
+
+
+def compile_block_rules(block_rules=None, blog_line_breaks=True):
+    """
+    Return the regexp of the block rules, BlockRules(blog_line_breaks)
+    by default, compiled once.
+    """
+    if block_rules is None:
+        key = bool(blog_line_breaks)
+    else:
+        key = (tuple(block_rules.rules), block_rules.re_flags)
+    try:
+        return _block_re_cache[key]
+    except KeyError:
+        pass
+
+    if block_rules is None:
+        block_rules = BlockRules(blog_line_breaks=blog_line_breaks)
+    block_re = re.compile('|'.join(block_rules.rules), block_rules.re_flags)
+    if len(_block_re_cache) >= BLOCK_RE_CACHE_SIZE:
+        # rules made on the fly, start again like the re module does
+        _block_re_cache.clear()
+    _block_re_cache[key] = block_re
+    return block_re
+
+
 class CreoleParser(object):
     """
     Parse the raw text and create a document object
@@ -44,7 +76,10 @@ class CreoleParser(object):
 
     # for link descriptions:
     link_re = re.compile(
-        '|'.join([InlineRules.image, InlineRules.linebreak, InlineRules.char]),
+        '|'.join([
+            InlineRules.image, InlineRules.linebreak, InlineRules.plain,
+            InlineRules.char
+        ]),
         re.VERBOSE | re.UNICODE
     )
     # for list items:
@@ -58,27 +93,44 @@ class CreoleParser(object):
     # For inline elements:
     inline_re = re.compile('|'.join(INLINE_RULES), INLINE_FLAGS)
 
+    # For finding the end of the blocks in feed():
+    pre_block_start_re = re.compile(SpecialRules.pre_block_start, re.VERBOSE | re.UNICODE)
+    macro_block_start_re = re.compile(SpecialRules.macro_block_start, re.VERBOSE | re.UNICODE)
+    head_only_re = re.compile(SpecialRules.head_only, re.VERBOSE | re.UNICODE)
+    lone_pipe_re = re.compile(SpecialRules.lone_pipe, re.VERBOSE | re.UNICODE)
+
 
     def __init__(self, raw, block_rules=None, blog_line_breaks=True):
         assert isinstance(raw, TEXT_TYPE)
         self.raw = raw
 
-        if block_rules is None:
-            block_rules = BlockRules(blog_line_breaks=blog_line_breaks)
-
         # setup block element rules:
-        self.block_re = re.compile('|'.join(block_rules.rules), block_rules.re_flags)
+        self.block_re = compile_block_rules(block_rules, blog_line_breaks)
 
         self.blog_line_breaks = blog_line_breaks
 
         self.root = DocNode('document', None)
         self.cur = self.root        # The most recent document node
         self.text = None            # The node to add inline characters to
+        self.texts = []             # Text nodes with parts to join
         self.last_text_break = None # Last break node, inserted by _text_repl()
 
         # Filled with all macros that's in the text
         self.root.used_macros = set()
 
+        # feed() state: the text not parsed yet, where its next line starts,
+        # the pre or macro block the line is in ('{{{' or the compiled end
+        # tag), if it follows blank lines that end the blocks, a heading
+        # without text, or a line it goes on in wiki style, whether the
+        # previous chunk ended with a \r
+        self.buffer = ""
+        self.scan_pos = 0
+        self.open_block = None
+        self.after_blank = False
+        self.after_head_only = False
+        self.joined = False
+        self.pending_cr = False
+
     #--------------------------------------------------------------------------
 
     def cleanup_break(self, old_cur):
@@ -111,12 +163,12 @@ class CreoleParser(object):
         self.cur = self._upto(self.cur, ('document',))# 'section', 'blockquote'))
 
     #__________________________________________________________________________
-    # The _*_repl methods called for matches in regexps. Sometimes the
-    # same method needs several names, because of group names in regexps.
+    # The _*_repl methods called with the matches of the regexps. Sometimes
+    # the same method needs several names, because of group names in regexps.
 
-    def _text_repl(self, groups):
+    def _text_repl(self, match):
 #        print("_text_repl()", self.cur.kind)
-#        self.debug_groups(groups)
+#        self.debug_groups(match.groupdict())
 
         if self.cur.kind in ('table', 'table_row', 'bullet_list', 'number_list'):
             self._upto_block()
@@ -124,15 +176,18 @@ class CreoleParser(object):
         if self.cur.kind in ('document', 'section', 'blockquote'):
             self.cur = DocNode('paragraph', self.cur)
 
-        text = groups.get('text', "")
+        text = match.group('text')
+        # only one of 'space' and 'break' is in the rule, depending on
+        # blog_line_breaks
+        groupindex = match.re.groupindex
 
-        if groups.get('space'):
+        if 'space' in groupindex and match.group('space'):
             # use wikipedia style line breaks and seperate a new line with one space
             text = " " + text
 
         self.parse_inline(text)
 
-        if groups.get('break') and self.cur.kind in ('paragraph',
+        if 'break' in groupindex and match.group('break') and self.cur.kind in ('paragraph',
             'emphasis', 'strong', 'pre_inline'):
             self.last_text_break = DocNode('break', self.cur, "")
 
@@ -140,33 +195,31 @@ class CreoleParser(object):
     _break_repl = _text_repl
     _space_repl = _text_repl
 
-    def _url_repl(self, groups):
+    def _url_repl(self, match):
         """Handle raw urls in text."""
-        if not groups.get('escaped_url'):
+        if not match.group('escaped_url'):
             # this url is NOT escaped
-            target = groups.get('url_target', "")
+            target = match.group('url_target')
             node = DocNode('link', self.cur)
             node.content = target
             DocNode('text', node, node.content)
             self.text = None
         else:
             # this url is escaped, we render it as text
-            if self.text is None:
-                self.text = DocNode('text', self.cur, "")
-            self.text.content += groups.get('url_target')
+            self._add_text(match.group('url_target'))
     _url_target_repl = _url_repl
     _url_proto_repl = _url_repl
     _escaped_url_repl = _url_repl
 
-    def _link_repl(self, groups):
+    def _link_repl(self, match):
         """Handle all kinds of links."""
-        target = groups.get('link_target', "")
-        text = (groups.get('link_text', "") or "").strip()
+        target = match.group('link_target')
+        text = (match.group('link_text') or "").strip()
         parent = self.cur
         self.cur = DocNode('link', self.cur)
         self.cur.content = target
         self.text = None
-        re.sub(self.link_re, self._replace, text)
+        self.link_re.sub(self._replace, text)
         self.cur = parent
         self.text = None
     _link_target_repl = _link_repl
@@ -174,28 +227,28 @@ class CreoleParser(object):
 
     #--------------------------------------------------------------------------
 
-    def _add_macro(self, groups, macro_type, name_key, args_key, text_key=None):
+    def _add_macro(self, match, macro_type, name_key, args_key, text_key=None):
         """
         generic method to handle the macro, used for all variants:
         inline, inline-tag, block
         """
-        #self.debug_groups(groups)
+        #self.debug_groups(match.groupdict())
         assert macro_type in ("macro_inline", "macro_block")
 
         if text_key:
-            macro_text = groups.get(text_key, "").strip()
+            macro_text = match.group(text_key).strip()
         else:
             macro_text = None
 
         node = DocNode(macro_type, self.cur, macro_text)
-        macro_name = groups[name_key]
+        macro_name = match.group(name_key)
         node.macro_name = macro_name
         self.root.used_macros.add(macro_name)
-        node.macro_args = groups.get(args_key, "").strip()
+        node.macro_args = match.group(args_key).strip()
 
         self.text = None
 
-    def _macro_block_repl(self, groups):
+    def _macro_block_repl(self, match):
         """
         block macro, e.g:
         <<macro args="foo">>
@@ -206,7 +259,7 @@ class CreoleParser(object):
         self._upto_block()
         self.cur = self.root
         self._add_macro(
-            groups,
+            match,
             macro_type="macro_block",
             name_key="macro_block_start",
             args_key="macro_block_args",
@@ -216,12 +269,12 @@ class CreoleParser(object):
     _macro_block_args_repl = _macro_block_repl
     _macro_block_text_repl = _macro_block_repl
 
-    def _macro_tag_repl(self, groups):
+    def _macro_tag_repl(self, match):
         """
         A single macro tag, e.g.: <<macro-a foo="bar">> or <<macro />>
         """
         self._add_macro(
-            groups,
+            match,
             macro_type="macro_inline",
             name_key="macro_tag_name",
             args_key="macro_tag_args",
@@ -231,12 +284,12 @@ class CreoleParser(object):
     _macro_tag_args_repl = _macro_tag_repl
 
 
-    def _macro_inline_repl(self, groups):
+    def _macro_inline_repl(self, match):
         """
         inline macro tag with data, e.g.: <<macro>>text<</macro>>
         """
         self._add_macro(
-            groups,
+            match,
             macro_type="macro_inline",
             name_key="macro_inline_start",
             args_key="macro_inline_args",
@@ -248,24 +301,24 @@ class CreoleParser(object):
 
     #--------------------------------------------------------------------------
 
-    def _image_repl(self, groups):
+    def _image_repl(self, match):
         """Handles images and attachemnts included in the page."""
-        target = groups.get('image_target', "").strip()
-        text = (groups.get('image_text', "") or "").strip()
+        target = match.group('image_target').strip()
+        text = (match.group('image_text') or "").strip()
         node = DocNode("image", self.cur, target)
         DocNode('text', node, text or node.content)
         self.text = None
     _image_target_repl = _image_repl
     _image_text_repl = _image_repl
 
-    def _separator_repl(self, groups):
+    def _separator_repl(self, match):
         self._upto_block()
         DocNode('separator', self.cur)
 
-    def _item_repl(self, groups):
+    def _item_repl(self, match):
         """ List item """
-        bullet = groups.get('item_head', "")
-        text = groups.get('item_text', "")
+        bullet = match.group('item_head')
+        text = match.group('item_text')
         if bullet[-1] == '#':
             kind = 'number_list'
         else:
@@ -293,20 +346,20 @@ class CreoleParser(object):
     _item_text_repl = _item_repl
     _item_head_repl = _item_repl
 
-    def _list_repl(self, groups):
+    def _list_repl(self, match):
         """ complete list """
-        self.item_re.sub(self._replace, groups["list"])
+        self.item_re.sub(self._replace, match.group('list'))
 
-    def _head_repl(self, groups):
+    def _head_repl(self, match):
         self._upto_block()
-        node = DocNode('header', self.cur, groups['head_text'].strip())
-        node.level = len(groups['head_head'])
+        node = DocNode('header', self.cur, match.group('head_text').strip())
+        node.level = len(match.group('head_head'))
         self.text = None
     _head_head_repl = _head_repl
     _head_text_repl = _head_repl
 
-    def _table_repl(self, groups):
-        row = groups.get('table', '|').strip()
+    def _table_repl(self, match):
+        row = match.group('table').strip()
         self.cur = self._upto(self.cur, (
             'table', 'document', 'section', 'blockquote'))
         if self.cur.kind != 'table':
@@ -323,16 +376,17 @@ class CreoleParser(object):
             else:
                 text = m.group('head').strip('= ')
                 self.cur = DocNode('table_head', tr)
-                self.text = DocNode('text', self.cur, "")
+                self.text = None
+                self._add_text("")
             self.parse_inline(text)
 
         self.cur = tb
         self.text = None
 
-    def _pre_block_repl(self, groups):
+    def _pre_block_repl(self, match):
         self._upto_block()
-        kind = groups.get('pre_block_kind', None)
-        text = groups.get('pre_block_text', "")
+        kind = match.group('pre_block_kind')
+        text = match.group('pre_block_text')
         def remove_tilde(m):
             return m.group('indent') + m.group('rest')
         text = self.pre_escape_re.sub(remove_tilde, text)
@@ -343,13 +397,13 @@ class CreoleParser(object):
     _pre_block_head_repl = _pre_block_repl
     _pre_block_kind_repl = _pre_block_repl
 
-    def _line_repl(self, groups):
+    def _line_repl(self, match):
         """ Transfer newline from the original markup into the html code """
         self._upto_block()
         DocNode('line', self.cur, "")
 
-    def _pre_inline_repl(self, groups):
-        text = groups.get('pre_inline_text', "")
+    def _pre_inline_repl(self, match):
+        text = match.group('pre_inline_text')
         DocNode('pre_inline', self.cur, text)
         self.text = None
     _pre_inline_text_repl = _pre_inline_repl
@@ -357,11 +411,11 @@ class CreoleParser(object):
 
     #--------------------------------------------------------------------------
 
-    def _inline_mark(self, groups, key):
+    def _inline_mark(self, match, key):
         self.cur = DocNode(key, self.cur)
 
         self.text = None
-        text = groups["%s_text" % key]
+        text = match.group(key + '_text')
         self.parse_inline(text)
 
         self.cur = self._upto(self.cur, (key,)).parent
@@ -369,90 +423,266 @@ class CreoleParser(object):
 
 
     # TODO: How can we generalize that:
-    def _emphasis_repl(self, groups):
-        self._inline_mark(groups, key='emphasis')
+    def _emphasis_repl(self, match):
+        self._inline_mark(match, key='emphasis')
     _emphasis_text_repl = _emphasis_repl
 
-    def _strong_repl(self, groups):
-        self._inline_mark(groups, key='strong')
+    def _strong_repl(self, match):
+        self._inline_mark(match, key='strong')
     _strong_text_repl = _strong_repl
 
-    def _monospace_repl(self, groups):
-        self._inline_mark(groups, key='monospace')
+    def _monospace_repl(self, match):
+        self._inline_mark(match, key='monospace')
     _monospace_text_repl = _monospace_repl
 
-    def _superscript_repl(self, groups):
-        self._inline_mark(groups, key='superscript')
+    def _superscript_repl(self, match):
+        self._inline_mark(match, key='superscript')
     _superscript_text_repl = _superscript_repl
 
-    def _subscript_repl(self, groups):
-        self._inline_mark(groups, key='subscript')
+    def _subscript_repl(self, match):
+        self._inline_mark(match, key='subscript')
     _subscript_text_repl = _subscript_repl
 
-    def _underline_repl(self, groups):
-        self._inline_mark(groups, key='underline')
+    def _underline_repl(self, match):
+        self._inline_mark(match, key='underline')
     _underline_text_repl = _underline_repl
 
-    def _small_repl(self, groups):
-        self._inline_mark(groups, key='small')
+    def _small_repl(self, match):
+        self._inline_mark(match, key='small')
     _small_text_repl = _small_repl
 
-    def _delete_repl(self, groups):
-        self._inline_mark(groups, key='delete')
+    def _delete_repl(self, match):
+        self._inline_mark(match, key='delete')
     _delete_text_repl = _delete_repl
 
     #--------------------------------------------------------------------------
 
-    def _linebreak_repl(self, groups):
+    def _linebreak_repl(self, match):
         DocNode('break', self.cur, None)
         self.text = None
 
-    def _escape_repl(self, groups):
-        if self.text is None:
-            self.text = DocNode('text', self.cur, "")
-        self.text.content += groups.get('escaped_char', "")
+    def _escape_repl(self, match):
+        self._add_text(match.group('escaped_char'))
     _escaped_char_repl = _escape_repl
 
-    def _char_repl(self, groups):
+    def _plain_repl(self, match):
+        self._add_text(match.group('plain'))
+
+    def _char_repl(self, match):
+        self._add_text(match.group('char'))
+
+    def _add_text(self, text):
+        """
+        Add text to the current text node, starting one if needed.
+        The parts are only joined by join_texts(), growing the content
+        string for each of them would be quadratic.
+        """
         if self.text is None:
             self.text = DocNode('text', self.cur, "")
-        self.text.content += groups.get('char', "")
+            self.text.parts = []
+            self.texts.append(self.text)
+        self.text.parts.append(text)
 
-    #--------------------------------------------------------------------------
+    def join_texts(self):
+        """Set the content of the text nodes started since the last call"""
+        for node in self.texts:
+            node.content = "".join(node.parts)
+            del node.parts
+        self.texts = []
 
-    def _replace(self, match):
-        """Invoke appropriate _*_repl method. Called for every matched group."""
+    #--------------------------------------------------------------------------
 
-#        def debug(groups):
-#            from pprint import pformat
-#            data = dict([
-#                group for group in groups.items() if group[1] is not None
-#            ])
-#            print("%s\n" % pformat(data))
+    @classmethod
+    def _handlers(cls):
+        """
+        The table of the _*_repl methods of the class, by group name.
+        Built once per class, with the methods of its subclasses too.
+        """
+        try:
+            return cls.__dict__['_handler_table']
+        except KeyError:
+            table = {}
+            for attr in dir(cls):
+                if attr.startswith('_') and attr.endswith('_repl'):
+                    method = getattr(cls, attr)
+                    table[attr[1:-len('_repl')]] = getattr(method, '__func__', method)
+            cls._handler_table = table
+            return table
 
-        groups = match.groupdict()
-        for name, text in groups.items():
-            if text is not None:
-                #if name != "char": debug(groups)
-                replace_method = getattr(self, '_%s_repl' % name)
-                replace_method(groups)
-                return
+    def _replace(self, match):
+        """Invoke appropriate _*_repl method. Called for every match."""
+        handlers = self._handlers()
+        name = match.lastgroup
+        if name not in handlers:
+            # a rule without a named outer group, take the first group that
+            # matched (may be from block_rules given by the user)
+            for name, text in match.groupdict().items():
+                if text is not None:
+                    break
+        handlers[name](self, match)
 
     def parse_inline(self, raw):
         """Recognize inline elements inside blocks."""
-        re.sub(self.inline_re, self._replace, raw)
+        self.inline_re.sub(self._replace, raw)
 
     def parse_block(self, raw):
         """Recognize block elements."""
-        re.sub(self.block_re, self._replace, raw)
+        self.block_re.sub(self._replace, raw)
 
     def parse(self):
         """Parse the text given as self.raw and return DOM tree."""
         # convert all lineendings to \n
         text = self.raw.replace("\r\n", "\n").replace("\r", "\n")
         self.parse_block(text)
+        self.join_texts()
         return self.root
 
+    #--------------------------------------------------------------------------
+
+    def feed(self, chunk):
+        """
+        Add the text chunk to the text to parse, parse the blocks that are
+        complete and return the top level nodes finished.
+
+        The text is parsed up to the last line after blank lines where no
+        match of the block rules can go on (not in a pre or macro block, not
+        the text of a heading...): the tree is the one parse() builds from
+        the whole text, given one top level node at a time. The finished nodes are removed from the
+        document tree, and only the text of the blocks still open is kept.
+        Works with the default block rules only.
+        """
+        assert isinstance(chunk, TEXT_TYPE)
+        if self.pending_cr:
+            chunk = "\r" + chunk
+        self.pending_cr = chunk.endswith("\r")
+        if self.pending_cr:
+            # may be the start of a \r\n
+            chunk = chunk[:-1]
+        self.buffer += chunk.replace("\r\n", "\n").replace("\r", "\n")
+
+        end = self._find_block_end()
+        if not end:
+            return []
+        # the matches are taken in the whole buffer: cut at the end, a
+        # blank line would match again as an empty line
+        last_end = None
+        for match in self.block_re.finditer(self.buffer):
+            if match.start() >= end:
+                break
+            if match.start() == match.end() == last_end:
+                # skipped by re.sub() used by parse_block()
+                continue
+            last_end = match.end()
+            self._replace(match)
+        self.buffer = self.buffer[end:]
+        self.scan_pos -= end
+        return self._finished_nodes(all_nodes=False)
+
+    def close(self):
+        """Parse the rest of the text, return the last top level nodes"""
+        text = self.buffer + ("\n" if self.pending_cr else "")
+        self.buffer = ""
+        self.scan_pos = 0
+        self.pending_cr = False
+        self.parse_block(text)
+        return self._finished_nodes(all_nodes=True)
+
+    def iter_blocks(self, chunks):
+        """
+        Parse self.raw then the text chunks, yield the top level nodes as
+        soon as they are finished.
+        """
+        for node in self.feed(self.raw):
+            yield node
+        for chunk in chunks:
+            for node in self.feed(chunk):
+                yield node
+        for node in self.close():
+            yield node
+
+    def _finished_nodes(self, all_nodes):
+        self.join_texts()
+        nodes = self.root.children
+        if not all_nodes and self.cur is not self.root and nodes:
+            # a table goes on after the blank lines, rows can be added
+            nodes, self.root.children = nodes[:-1], nodes[-1:]
+        else:
+            self.root.children = []
+        return nodes
+
+    def _find_block_end(self):
+        """
+        Scan the complete lines of the buffer not scanned yet, return where
+        the last line no block goes across starts, or None.
+        """
+        end = None
+        buffer = self.buffer
+        pos = self.scan_pos
+        while True:
+            eol = buffer.find("\n", pos)
+            if eol == -1:
+                break
+            line = buffer[pos:eol]
+            pos = eol + 1
+            if self.open_block is not None:
+                start = self._block_end(line)
+                if start is None:
+                    continue
+                self.open_block = None
+                self._block_start(line, start)
+            elif not line.strip():
+                # a heading without text takes the next line after the
+                # blank lines for its text, in wiki style the line after a
+                # blank line with spaces goes on with its newline
+                self.after_blank = not self.after_head_only and (
+                    self.blog_line_breaks or not line)
+                self.joined = not self.blog_line_breaks and bool(line)
+                continue
+            elif self.after_head_only:
+                # the text of the heading
+                self.after_head_only = False
+            elif self.joined:
+                # in wiki style, the text of the previous line goes on
+                pass
+            else:
+                if self.after_blank and not self.lone_pipe_re.match(line):
+                    end = pos - len(line) - 1
+                self.after_head_only = bool(self.head_only_re.match(line))
+                self._block_start(line, 0)
+            self.after_blank = False
+            # "\\" at the end of the line keeps the next one apart
+            self.joined = not self.blog_line_breaks and not line.endswith("\\")
+        self.scan_pos = pos
+        return end
+
+    def _block_start(self, line, pos):
+        """Set open_block if a pre or macro block starts at pos in the line"""
+        while True:
+            if pos == 0 and self.pre_block_start_re.match(line):
+                self.open_block = "{{{"
+                return
+            match = self.macro_block_start_re.match(line, pos)
+            if match is None:
+                return
+            end_re = re.compile(
+                r'<</ \s* %s \s* >>' % re.escape(match.group('name')),
+                re.VERBOSE | re.UNICODE
+            )
+            end = end_re.search(line, match.end())
+            if end is None:
+                self.open_block = end_re
+                return
+            # another block may start after the end tag
+            pos = end.end()
+
+    def _block_end(self, line):
+        """Where the open block ends in the line, None if it goes on"""
+        if self.open_block == "{{{":
+            if line.startswith("}}}"):
+                return len("}}}")
+            return None
+        match = self.open_block.search(line)
+        return match and match.end()
 
     #--------------------------------------------------------------------------
     def debug(self, start_node=None):
@@ -95,6 +95,14 @@ class InlineRules(object):
 
     linebreak = r'(?P<linebreak> \\\\ )'
     escape = r'(?P<escape> ~ (?P<escaped_char>\S) )'
+
+    # plain text, up to the next character that may start markup or the next
+    # word that is a raw url, so prose is matched a run at a time, not a
+    # character at a time
+    plain = r'''(?P<plain>
+            [^\s\[<{*/\#^,_\-~\\]+
+            (?: \s+ (?! (%s):// ) [^\s\[<{*/\#^,_\-~\\]+ )*
+        )''' % proto
     char = r'(?P<char> . )'
 
 
@@ -204,6 +212,14 @@ class SpecialRules(object):
     # For pre escaping, in creole 1.0 done with ~:
     pre_escape = r' ^(?P<indent>\s*) ~ (?P<rest> \}\}\} \s*) $'
 
+    # For finding the lines that open a pre or a macro block, make a
+    # heading out of the next non blank line, or end the table row before
+    # the blank lines:
+    pre_block_start = r'{{{ \s* $'
+    macro_block_start = r'<< \s* (?P<name>\w+) \s* .*? \s* >>'
+    head_only = r'=+ \s* $'
+    lone_pipe = r'\s* [|] \s* $'
+
 
 INLINE_FLAGS = re.VERBOSE | re.UNICODE
 INLINE_RULES = (
@@ -217,7 +233,7 @@ INLINE_RULES = (
     InlineRules.small, InlineRules.delete,
 
     InlineRules.linebreak,
-    InlineRules.escape, InlineRules.char
+    InlineRules.escape, InlineRules.plain, InlineRules.char
 )
 
 
@@ -0,0 +1,216 @@
+# coding: utf-8
+
+
+"""
+    python-creole - cache of conversion results
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Used by creole2html(), html2creole() and html2rest() once enabled with
+    creole.set_conversion_cache().
+
+    :copyleft: 2008-2015 by python-creole team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import codecs
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+
+def option_key(value):
+    """
+    Return the key of a conversion option and whether it is the same in
+    every process (so its results can be stored on disk).
+
+    None, booleans and strings are keyed by value. The functions of
+    python-creole (e.g. the unknown_emit functions) by their name. Other
+    objects (macros, url_map...) by identity: the cache keeps a reference
+    to them, so the key is not given to another object while cached.
+
+    >>> option_key(True)
+    (True, True)
+    >>> from creole.shared.unknown_tags import escape_unknown_nodes
+    >>> option_key(escape_unknown_nodes)
+    ('creole.shared.unknown_tags.escape_unknown_nodes', True)
+    """
+    if value is None or isinstance(value, (bool, int, type(""))):
+        return value, True
+    module = getattr(value, "__module__", None) or ""
+    name = getattr(value, "__name__", None)
+    if name and (module == "creole" or module.startswith("creole.")):
+        return "%s.%s" % (module, name), True
+    return ("id", id(value)), False
+
+
+class ConversionCache(object):
+    """
+    Least recently used conversion results, keyed by the hash of the
+    converted text and the conversion options.
+
+    max_size:
+        total length of the results kept in memory, in characters (the
+        texts are only kept as hashes)
+    directory:
+        if given, the results are also stored there, one file each, and
+        found again by the next processes. Only the results of conversions
+        with options known to all processes (see option_key()) are stored.
+        Nothing is ever removed from the directory: empty it when upgrading
+        python-creole.
+
+    >>> cache = ConversionCache(max_size=100)
+    >>> cache.get("creole2html", "**x**", ()) is None
+    True
+    >>> cache.put("creole2html", "**x**", (), "<p><strong>x</strong></p>")
+    >>> cache.get("creole2html", "**x**", ())
+    '<p><strong>x</strong></p>'
+    >>> print(cache.info())
+    conversion cache: 1 hits (0 from disk), 1 misses, 0 evictions, 1 entries, 25 of 100 characters
+    """
+    def __init__(self, max_size=10 * 1024 * 1024, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key -> (result, size)
+        self._pinned = {} # key -> option objects keyed by identity
+        self.size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, kind, text, options):
+        keys = []
+        portable = True
+        for value in options:
+            key, value_portable = option_key(value)
+            keys.append(key)
+            portable = portable and value_portable
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return (kind, digest, tuple(keys)), portable
+
+    def _filename(self, key):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name[:2], name[2:] + ".txt")
+
+    def get(self, kind, text, options):
+        """
+        Return the result of the conversion 'kind' of 'text' with the
+        'options' values, None if it is not cached.
+        """
+        key, portable = self._key(kind, text, options)
+        with self._lock:
+            try:
+                result, size = self._entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                # most recently used at the end
+                self._entries[key] = (result, size)
+                self.hits += 1
+                return result
+
+        if self.directory is not None and portable:
+            try:
+                with codecs.open(self._filename(key), "r", "utf-8") as f:
+                    result = f.read()
+            except (IOError, OSError):
+                pass
+            else:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                self._remember(key, result, options)
+                return result
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, kind, text, options, result):
+        """
+        Store 'result', the conversion 'kind' of 'text' with the 'options'
+        values.
+        """
+        key, portable = self._key(kind, text, options)
+        self._remember(key, result, options)
+        if self.directory is not None and portable:
+            self._write(self._filename(key), result)
+
+    def _remember(self, key, result, options):
+        size = len(result)
+        if size > self.max_size:
+            # would evict everything else
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (result, size)
+            self._pinned[key] = [value for value in options
+                                 if not option_key(value)[1]]
+            self.size += size
+            while self.size > self.max_size:
+                old_key, (_, old_size) = self._entries.popitem(last=False)
+                del self._pinned[old_key]
+                self.size -= old_size
+                self.evictions += 1
+
+    def _write(self, filename, result):
+        # written to a temporary file renamed once complete, so another
+        # process never reads a part of it
+        dirname = os.path.dirname(filename)
+        tmp = None
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(result.encode("utf-8"))
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            # another process made the directory or the file first, or the
+            # disk is full: the result stays in memory
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def clear(self):
+        """
+        Forget the results kept in memory, and the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+            self.size = 0
+            self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Return the statistics: hits (disk_hits of them from the directory),
+        misses, evictions, number of entries and size kept in memory.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_size": self.max_size,
+            }
+
+    def info(self):
+        return (
+            "conversion cache: %(hits)i hits (%(disk_hits)i from disk),"
+            " %(misses)i misses, %(evictions)i evictions, %(entries)i entries,"
+            " %(size)i of %(max_size)i characters"
+        ) % self.stats()
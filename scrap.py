@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
 import itertools
-import urlparse
 import json
 import os
 import re
-import urllib
+import argparse
 from StringIO import StringIO
-import HTMLParser
 
-#from html2rest import html2rest
-from creole import html2rest
-
-from webscraping import common, download, xpath
+from webscraping import common
+from scraper.cache import normalize_url, open_cache
+from scraper.convert import ConversionPool
+from scraper.dedup import FingerprintIndex, fingerprint
+from scraper.dirindex import DirectoryIndex
+from scraper.extract import extract_article
+from scraper.fetch import WAIT_TIMEOUT, PageFetcher
+from scraper.images import ImageDownloader
+from scraper.listing import list_articles
+from scraper.lost import LostImages
+from scraper.manifest import Manifest, content_hash
+from scraper.metrics import Metrics, null_metrics
+from scraper.optimize import Image, ImageOptimizer
+from scraper.state import (CONVERTED, EXTRACTED, FETCHED, IMAGES_DONE,
+                           WRITTEN, PipelineState)
+from scraper.store import ImageStore
+from scraper.utils import atomic_write
+from scraper.workqueue import WorkQueue
 
 from jinja2 import Markup
 import six
@@ -20,64 +32,40 @@ import six
 DOMAIN = 'http://acr.dijon.over-blog.com/'
 #writer = common.UnicodeWriter('articles.csv')
 #writer.writerow(['Title', 'Num reads', 'URL'])
-seen_urls = set() # track which articles URL's already seen, to prevent duplicates
-D = download.Download(cache_file='cache', num_retries=3)
 
 years = range(2005, 2016)
 root = 'archive/%d-%.2d/'
-articles = []
 
-def load_list():
+
+def load_list(cache, num_workers=8, use_network=True, delay=5,
+              metrics=None):
     if os.path.exists('articles.json'):
         with open('articles.json') as f:
             return json.loads(f.read())
 
-    for year in years:
-        print('Listing %d' % year)
-        for month in range(1, 13):
-            page = root % (year, month)
-            url = urlparse.urljoin(DOMAIN, page)
-            archive = D.get(url)
-
-            for path in ('//li[@class="listArticles  article_item_even"]/a/@href',
-                        '//li[@class="listArticles  article_item_odd"]/a/@href'):
-
-                articles.extend(xpath.search(archive, path))
-
-    with open('articles.json', 'w') as f:
-        f.write(json.dumps(articles))
-
-
-_h = HTMLParser.HTMLParser()
-
-def html2text(html):
-    return _h.unescape(html)
+    print('Listing %d-%d' % (years[0], years[-1]))
+    fetcher = PageFetcher(num_workers=num_workers, cache=cache,
+                          num_retries=3, use_network=use_network, delay=delay,
+                          metrics=metrics, stage='listing')
+    articles = list_articles(fetcher, DOMAIN, root, years)
+    atomic_write('articles.json', json.dumps(articles))
+    return articles
 
 
-def lost_image(url):
-    if os.path.exists('lost_images.json'):
-        with open('lost_images.json') as f:
-            try:
-                return url in json.loads(f.read())
-            except ValueError:
-                return False
-    else:
-        return False
-
-def add_lost_image(url):
-    if os.path.exists('lost_images.json'):
-        with open('lost_images.json') as f:
-            try:
-                lost = json.loads(f.read())
-            except ValueError:
-                lost = []
-    else:
-        lost = []
+def unique_urls(urls):
+    """``urls`` in order, without the ones seen before
 
-    if url not in lost:
-        lost.append(url)
-        with open('lost_images.json', 'w') as f:
-            f.write(json.dumps(lost))
+    The same article is sometimes listed under URLs differing only by case,
+    port or fragment.
+    """
+    seen_urls = set()
+    unique = []
+    for url in urls:
+        key = normalize_url(url)
+        if key not in seen_urls:
+            seen_urls.add(key)
+            unique.append(url)
+    return unique
 
 
 def slugify(value, substitutions=()):
@@ -97,79 +85,485 @@ def slugify(value, substitutions=()):
     return value.decode('ascii')
 
 
-TMP = u"""\
-%(title)s
-%(title_under)s
-
-:date: %(date)s
-:category: Résultats
-:summary: %(title)s
-
-%(content)s
-"""
-
-articles = load_list()
 image_dir = 'images'
 assets = 'http://assets.acr-dijon.org/old/'
 
-
-for article in articles:
-    page = D.get(article)
-    if not page:
-        print('Failed on %s' % article)
-        continue
-
-    page = page.decode('utf8')
-    data = {}
-    data['title'] = xpath.search(page, '//a[@class="titreArticle"]')[0]
-
-    data['title_under'] = '=' * len(data['title'])
-    content = xpath.search(page,
-            '//div[@class="contenuArticle"]')[0].strip()
-
-
-    day = int(xpath.search(page, '//span[@class="day"]')[0])
-    month = int(xpath.search(page, '//span[@class="month"]')[0][-2:])
-    year = int(xpath.search(page, '//span[@class="year"]')[0][-4:])
-    hour = xpath.search(page, '//span[@class="hour"]')[0]
-    date = '%d-%.2d-%.2d %s' % (year, month, day, hour)
-    data['date'] = date
-    name = slugify(date + '-' + data['title']) + '.rst'
-    filename = os.path.join('archives', name)
-    if os.path.exists(filename):
-        continue
-
-    # images in the content
-    images = xpath.search(page, '//img/@src')
-    images = [image.strip() for image in images if image in content
-              and image.strip() != '']
-
-    for image in images:
-        i_path, i_filename = os.path.split(image)
-        i_filename, ext = os.path.splitext(i_filename)
-        local_name = slugify(i_path + '-' + i_filename) + ext
-        content = content.replace(image, assets + local_name)
-        disk_name = os.path.join(image_dir, local_name)
-
-        if os.path.exists(disk_name):
-            continue
-
-        if lost_image(image):
-            print('Image does not exist anymore ' + image)
-            continue
-
-        print('Downloading %s' % image)
+# bump when TMP or the conversion changes, to redo all the articles
+CONVERTER_VERSION = 2
+
+
+def legacy_image_name(image):
+    """Name images were saved under before the content addressed store"""
+    i_path, i_filename = os.path.split(image)
+    i_filename, ext = os.path.splitext(i_filename)
+    return slugify(i_path + '-' + i_filename) + ext
+
+
+class Scraper(object):
+    """Turn downloaded article pages into rst files
+
+    lost:
+        LostImages registry
+    store:
+        ImageStore holding the images
+    downloader:
+        ImageDownloader for the images not in the store, or None to leave
+        them alone (their original URL is kept)
+    converter:
+        ConversionPool rendering the articles
+    manifest:
+        Manifest of the converted articles
+    rerender:
+        convert again articles whose file exists but is not in the
+        manifest, instead of only recording them
+    metrics:
+        Metrics receiving the extraction and write timings, or None
+    refresh:
+        revalidate the images already in the store, and skip the articles
+        whose page and images did not change since they were converted
+    archives:
+        DirectoryIndex of the output directory
+    optimizer:
+        ImageOptimizer whose images the articles use instead of the ones
+        downloaded, or None
+    queue:
+        WorkQueue the articles were leased from, marked done or failed as
+        they are processed, or None
+    state:
+        PipelineState receiving the stage reached by each article, or None
+    dedup:
+        FingerprintIndex of the articles converted: an article repeating
+        one of them is not converted, its manifest entry points to the
+        file of the first one. None to convert every article.
+    """
+
+    def __init__(self, lost, store, downloader, converter, manifest,
+                 rerender=False, metrics=None, refresh=False, archives=None,
+                 optimizer=None, queue=None, state=None, dedup=None):
+        self.lost = lost
+        self.store = store
+        self.downloader = downloader
+        self.converter = converter
+        self.manifest = manifest
+        self.rerender = rerender
+        self.metrics = metrics or null_metrics
+        self.refresh = refresh
+        self.archives = archives if archives is not None \
+            else DirectoryIndex('archives')
+        self.optimizer = optimizer
+        self.queue = queue
+        self.state = state
+        self.dedup = dedup
+        if manifest is not None:
+            for url, entry in manifest.entries.items():
+                # a duplicate shares the file of its original
+                if dedup is None or url not in dedup.duplicates:
+                    self.archives.claim(os.path.basename(entry['filename']),
+                                        url)
+        self.num_written = self.num_unchanged = 0
+
+    def process_article(self, article, page):
+        if not page:
+            print('Failed on %s' % article)
+            self.metrics.count('pages failed')
+            self.failed(article, 'fetch', 'download failed')
+            return
+
+        # known to the state: started by a run since the state exists
+        started = self.state is not None and article in self.state
+        page_hash = content_hash(page)
+        self.advance(article, FETCHED, page_hash=page_hash)
+        try:
+            with self.metrics.time('extract'):
+                record = extract_article(article, page.decode('utf8'))
+        except ValueError as e:
+            print('Failed on %s' % e)
+            self.metrics.count('extractions failed')
+            self.failed(article, 'extract', str(e), retry=False)
+            return
+
+        if self.dedup is not None:
+            with self.metrics.time('dedup'):
+                fingerprints = fingerprint(record)
+                original, exact = self.dedup.find(article, fingerprints)
+            if original is not None:
+                self.skip_duplicate(article, original, exact, page_hash)
+                return
+
+        name = self.output_name(article, record)
+        filename = self.archives.path(name)
+        if self.dedup is not None:
+            self.dedup.add(article, fingerprints, filename)
+        self.advance(article, EXTRACTED, filename=filename)
+        if not self.rerender and name in self.archives \
+                and article not in self.manifest and not started:
+            # converted before the manifest existed; the file of a started
+            # article may be from a run that did not finish it
+            self.manifest.record(article, filename, page_hash)
+            self.metrics.count('articles recorded')
+            self.advance(article, WRITTEN)
+            self.done(article)
+            return
+
+        unchanged = (self.refresh and self.manifest.is_done(article)
+                     and self.manifest.get(article)['hash'] == page_hash)
+        if unchanged:
+            stored = dict((image, self.store.lookup(image))
+                          for image in record.images)
+
+        local_names = self.local_images(record.images)
+        # images gone for good are not worth another try
+        missing = len([image for image in record.images
+                       if image not in local_names
+                       and (self.lost is None or image not in self.lost)])
+        self.advance(article, IMAGES_DONE, images_missing=missing)
+        if unchanged and stored == dict((image, local_names.get(image))
+                                        for image in record.images):
+            self.metrics.count('articles not modified')
+            self.advance(article, WRITTEN)
+            self.done(article)
+            return
+        urls = dict((image, assets + self.asset_name(local_name))
+                    for image, local_name in local_names.items())
+
+        def write(page):
+            self.advance(article, CONVERTED)
+            try:
+                with self.metrics.time('write'):
+                    self.write(filename, page)
+            except (IOError, OSError) as e:
+                print('Failed to write %s: %s' % (filename, e))
+                self.failed(article, 'write', str(e))
+                return
+            self.manifest.record(article, filename, page_hash)
+            self.advance(article, WRITTEN)
+            self.done(article)
+
+        def conversion_failed(error):
+            self.failed(article, 'convert', repr(error), retry=False)
+
+        self.converter.submit(record, write, urls, conversion_failed)
+
+    def skip_duplicate(self, article, original, exact, page_hash):
+        """Record ``article`` as done by the file of ``original``"""
+        filename = self.dedup.entries[original]['filename']
+        print('%s is %s duplicate of %s, not converted' % (
+            article, 'an exact' if exact else 'a near', original))
+        self.metrics.count('exact duplicates' if exact
+                           else 'near duplicates')
+        self.dedup.add_duplicate(article, original)
+        self.manifest.record(article, filename, page_hash)
+        self.advance(article, WRITTEN, filename=filename)
+        self.done(article)
+
+    def advance(self, article, stage, **fields):
+        """Record that ``article`` reached ``stage``"""
+        if self.state is not None:
+            self.state.advance(article, stage, **fields)
+
+    def done(self, article):
+        """Mark ``article`` done in the queue"""
+        if self.queue is not None:
+            self.queue.done('article', article)
+
+    def failed(self, article, step, error, retry=True):
+        """Record that ``step`` failed for ``article`` because of
+        ``error``, and mark it failed in the queue (to be tried again
+        with ``retry``)
+        """
+        if self.state is not None:
+            self.state.fail(article, step, error)
+        if self.queue is not None:
+            self.queue.fail('article', article, error, retry=retry)
+
+    def output_name(self, article, record):
+        """Name of the rst file of ``article``, made unique when another
+        article already has the same slug
+        """
+        slug = slugify(record.date + '-' + record.title)
+        name = slug + '.rst'
+        if self.archives.claim(name, article):
+            return name
+        unique = '%s-%s.rst' % (slug, content_hash(article)[:8])
+        if self.archives.owners.get(unique) != article:
+            print('%s has the same name as %s, written as %s' % (
+                article, self.archives.owners[name], unique))
+            self.metrics.count('name collisions')
+            self.archives.claim(unique, article)
+        return unique
+
+    def local_images(self, images):
+        """Return the blob names of ``images``, downloading the new ones
+        """
+        local_names = {}
+        pending = []
+        for image in images:
+            local_name = self.store.lookup(image)
+            if local_name is not None and self.refresh \
+                    and self.downloader is not None:
+                # the current blob is kept if the image cannot be checked
+                local_names[image] = local_name
+                pending.append((image, self.downloader.submit(image)))
+                continue
+            if local_name is None:
+                local_name = self.adopt_legacy(image)
+            if local_name is not None:
+                local_names[image] = local_name
+            elif image in self.lost:
+                print('Image does not exist anymore ' + image)
+            elif self.downloader is not None:
+                print('Downloading %s' % image)
+                pending.append((image, self.downloader.submit(image)))
+
+        for image, result in pending:
+            local_name = result.get(WAIT_TIMEOUT)
+            if local_name is not None:
+                local_names[image] = local_name
+        return local_names
+
+    def asset_name(self, local_name):
+        """Name of the image to use in the articles for the blob
+        ``local_name``, relative to the assets site
+        """
+        if self.optimizer is None:
+            return local_name
+        return self.optimizer.submit(local_name)
+
+    def adopt_legacy(self, image):
+        """Add to the store the file ``image`` was saved to before the
+        store existed, return its blob name or None
+        """
+        legacy = legacy_image_name(image)
+        if legacy not in self.store.files:
+            return None
+        if not self.store.files.claim(legacy, image):
+            # the old naming gave both images the same file, which holds
+            # whichever was downloaded last
+            print('%s has the same file as %s, not using it' % (
+                image, self.store.files.owners[legacy]))
+            self.metrics.count('name collisions')
+            return None
+        return self.store.adopt(image, self.store.files.path(legacy))
+
+    def write(self, filename, page):
+        """Write ``page`` unless ``filename`` already holds it
+        """
+        data = page.encode('utf8')
+        if self.archives.exists(filename):
+            with open(filename) as f:
+                if f.read() == data:
+                    self.num_unchanged += 1
+                    self.metrics.count('articles unchanged')
+                    return
+        print('Writing %s' % filename)
+        # never a partial file, that a restart would take for a converted
+        # article
+        atomic_write(filename, data)
+        self.archives.add(os.path.basename(filename))
+        self.num_written += 1
+        self.metrics.count('articles written')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert the acr.dijon.over-blog.com articles to rst')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of pages downloaded at the same time')
+    parser.add_argument('--image-workers', type=int, default=4,
+                        help='number of images downloaded at the same time')
+    parser.add_argument('--image-rate', type=float, default=20,
+                        help='maximum image requests per second to one host, '
+                             '0 for no limit')
+    parser.add_argument('--image-host-workers', type=int, default=4,
+                        help='maximum number of images downloaded at the same '
+                             'time from one host')
+    parser.add_argument('--convert-workers', type=int, default=None,
+                        help='number of conversion processes, one per CPU by '
+                             'default, 0 to convert in the main process')
+    parser.add_argument('--rerender', action='store_true',
+                        help='convert all the articles again from the '
+                             'download cache, without any download')
+    parser.add_argument('--refresh', action='store_true',
+                        help='revalidate the cached pages and the stored '
+                             'images, and convert again the articles that '
+                             'changed')
+    parser.add_argument('--delay', type=float, default=5,
+                        help='seconds each worker waits between two pages')
+    parser.add_argument('--list-workers', type=int, default=8,
+                        help='number of archive pages listed at the same time')
+    parser.add_argument('--cache', default='pages.db',
+                        help='page cache database (the old "cache" file is '
+                             'imported into it when it does not exist)')
+    parser.add_argument('--cache-ttl', type=float, default=None,
+                        help='days after which a cached page is downloaded '
+                             'again')
+    parser.add_argument('--cache-max-size', type=int, default=None,
+                        help='size of the page cache in MB, least recently '
+                             'used pages are evicted beyond it')
+    parser.add_argument('--optimize-images', action='store_true',
+                        help='recompress and downsize the images, and use '
+                             'the optimized ones in the articles (with '
+                             '--rerender to update the articles already '
+                             'converted); needs Pillow')
+    parser.add_argument('--max-image-size', type=int, default=1600,
+                        help='largest width or height of the optimized '
+                             'images, in pixels')
+    parser.add_argument('--image-quality', type=int, default=85,
+                        help='JPEG quality of the optimized images')
+    parser.add_argument('--optimize-workers', type=int, default=None,
+                        help='number of image optimization processes, one '
+                             'per CPU by default')
+    parser.add_argument('--queue', metavar='FILE',
+                        help='share the articles and images with the other '
+                             'scraper processes using the work queue '
+                             'database FILE (on a shared volume for several '
+                             'machines); the processes can share their '
+                             'working directory, the indexes are merged '
+                             'under a lock when saved, and the page cache '
+                             'and the state databases are kept out of WAL '
+                             'mode, which needs all the processes on one '
+                             'machine')
+    parser.add_argument('--queue-lease', type=float, default=300,
+                        help='seconds after which the work of a worker that '
+                             'stopped responding is given to another one')
+    parser.add_argument('--queue-retry-failed', action='store_true',
+                        help='try again the articles and images that failed '
+                             'in the queue')
+    parser.add_argument('--state', default='state.db',
+                        help='database of the stage reached by each '
+                             'article, where a restart resumes from')
+    parser.add_argument('--failures', action='store_true',
+                        help='list the articles that failed, with the step '
+                             'and the reason, and exit')
+    parser.add_argument('--dedup', action='store_true',
+                        help='do not convert the articles repeating an '
+                             'earlier one (same title, text, images and '
+                             'links), point them to its file')
+    parser.add_argument('--dedup-similarity', type=float, default=0.8,
+                        help='similarity (0 to 1) from which two articles '
+                             'are taken as the same with --dedup, 1 to only '
+                             'skip exact duplicates')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='time each stage, print a summary and write it '
+                             'as JSON to FILE')
+    args = parser.parse_args(argv)
+    if args.refresh and args.rerender:
+        parser.error('--refresh and --rerender are exclusive')
+    if args.queue and (args.refresh or args.rerender):
+        parser.error('--queue cannot be used with --refresh or --rerender')
+    if args.optimize_images and Image is None:
+        parser.error('--optimize-images needs Pillow')
+
+    # WAL only works between the processes of one machine
+    wal = not args.queue
+    state = PipelineState(args.state, wal=wal)
+    if args.failures:
+        for url, step, error, attempts in state.failures():
+            print('%s: %s failed after %d attempt(s): %s' % (
+                url, step, attempts, error))
+        print(state.report())
+        return
+
+    metrics = Metrics() if args.metrics else null_metrics
+    # fork the conversion processes before any thread is started
+    converter = ConversionPool(args.convert_workers, metrics=metrics)
+    optimizer = None
+    if args.optimize_images:
+        optimizer = ImageOptimizer(image_dir, max_size=args.max_image_size,
+                                   quality=args.image_quality,
+                                   num_workers=args.optimize_workers,
+                                   metrics=metrics)
+    # a rerender only reads the download cache
+    use_network = not args.rerender
+    cache = open_cache(
+        args.cache, legacy='cache',
+        ttl=args.cache_ttl and args.cache_ttl * 24 * 3600,
+        max_size=args.cache_max_size and args.cache_max_size * 1024 * 1024,
+        wal=wal)
+    articles = load_list(cache, args.list_workers, use_network=use_network,
+                         delay=args.delay, metrics=metrics)
+    articles = unique_urls(articles)
+    archives = DirectoryIndex('archives')
+    manifest = Manifest('manifest.json', version=CONVERTER_VERSION,
+                        exists=archives.exists)
+    dedup = None
+    if args.dedup:
+        dedup = FingerprintIndex('fingerprints.json',
+                                 min_similarity=args.dedup_similarity)
+    if not args.rerender and not args.refresh:
+        # the ones a previous run started but did not complete, failed or
+        # written without all their images, are done again, and so are
+        # the duplicates found by an older fingerprint
+        unfinished = state.unfinished()
+        recheck = dedup.recheck if dedup is not None else set()
+        articles = [article for article in articles
+                    if not manifest.is_done(article) or article in unfinished
+                    or article in recheck]
+        if unfinished:
+            print('%d articles not complete from previous runs (%d failed, '
+                  'see --failures)' % (len(unfinished),
+                                       len(state.failures())))
+        if recheck:
+            print('%d duplicates checked again with the current '
+                  'fingerprints' % len(recheck))
+    queue = None
+    if args.queue:
+        queue = WorkQueue(args.queue, lease_time=args.queue_lease)
+        if args.queue_retry_failed:
+            for kind in ('article', 'image'):
+                queue.retry_failed(kind)
+        # every worker adds its list, the ones already queued are ignored
+        queue.put('article', articles)
+    fetcher = PageFetcher(num_workers=args.workers, cache=cache,
+                          num_retries=3, use_network=use_network,
+                          delay=args.delay, metrics=metrics,
+                          refresh=args.refresh)
+    with LostImages('lost_images.json') as lost, ImageStore(image_dir) as store:
+        downloader = ImageDownloader(store, num_workers=args.image_workers,
+                                     rate=args.image_rate or None,
+                                     max_per_host=args.image_host_workers,
+                                     lost=lost, metrics=metrics, queue=queue)
+        scraper = Scraper(lost, store,
+                          None if args.rerender else downloader,
+                          converter, manifest, rerender=args.rerender,
+                          metrics=metrics, refresh=args.refresh,
+                          archives=archives, optimizer=optimizer,
+                          queue=queue, state=state, dedup=dedup)
+        rounds = [articles] if queue is None else queue.rounds('article')
         try:
-            urllib.urlretrieve(image, filename=disk_name)
-        except IOError:
-            print('Image does not exist anymore ' + image)
-            add_lost_image(image)
-            continue
-
-    content = html2text(content)
-    content = html2rest(content)
-    data['content'] = content
-    print('Writing %s' % filename)
-    page = TMP % data
-    with open(filename, 'w') as f:
-        f.write(page.encode('utf8'))
+            with downloader, manifest, converter:
+                for articles in rounds:
+                    for article, page in fetcher.imap(articles):
+                        scraper.process_article(article, page)
+                    # the articles of the round are marked done as they
+                    # are written
+                    converter.flush()
+        finally:
+            if dedup is not None:
+                dedup.save()
+            if queue is not None:
+                # the articles not processed go back to the other workers
+                queue.close()
+        if optimizer is not None:
+            optimizer.close()
+        if queue is not None:
+            print(queue.report())
+        if downloader.started is not None:
+            print(downloader.report())
+            for url, error in downloader.failures:
+                print('  %s: %s' % (url, error))
+        print(store.report())
+        if optimizer is not None:
+            print(optimizer.report())
+        print('%d articles written, %d unchanged' % (scraper.num_written,
+                                                     scraper.num_unchanged))
+        print(state.report())
+    if metrics.enabled:
+        metrics.count('cache hits', cache.hits)
+        metrics.count('cache misses', cache.misses)
+        print(metrics.report())
+        metrics.save(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Helpers for the acr.dijon.over-blog.com scraper (see scrap.py)."""
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""Compressed, size bounded HTTP page cache for webscraping's Download.
+
+``PageCache`` has the dict like interface Download expects from its
+``cache`` argument, so it can replace the pdict file:
+
+    download.Download(cache=PageCache('pages.db'), ...)
+"""
+import cPickle as pickle
+import json
+import os
+import sqlite3
+import threading
+import time
+import urlparse
+import zlib
+
+from scraper.utils import file_lock
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """Cache key of ``url``: scheme and host lower cased, default port and
+    fragment dropped, empty path replaced by /
+
+    >>> normalize_url('HTTP://Acr.Dijon.Over-Blog.com:80/article-1.html#top')
+    'http://acr.dijon.over-blog.com/article-1.html'
+    """
+    parts = urlparse.urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = '%s:%d' % (host, parts.port)
+    if parts.username:
+        host = '%s@%s' % (parts.netloc.rsplit('@', 1)[0], host)
+    return urlparse.urlunsplit((scheme, host, parts.path or '/',
+                                parts.query, ''))
+
+
+class PageCache(object):
+    """Cache of downloaded pages in a SQLite database
+
+    Values are pickled and zlib compressed, keyed by normalized URL, with
+    the time they were fetched and last read. Every thread gets its own
+    connection, so one instance can be shared by all the download threads.
+    The database is in WAL mode, where readers do not block, unless
+    ``wal`` is False: WAL needs all the processes on the same machine, the
+    rollback journal also works for a database on a volume shared by
+    several machines.
+
+    filename:
+        the SQLite database
+    ttl:
+        seconds after which an entry is stale and downloaded again, None to
+        keep entries forever
+    max_size:
+        maximum size in bytes of the compressed values; the least recently
+        read entries are evicted beyond it. None for no limit
+    compress_level:
+        zlib compression level
+    check_every:
+        how many writes between two checks of the total size
+    wal:
+        use WAL mode
+    """
+
+    def __init__(self, filename='pages.db', ttl=None, max_size=None,
+                 compress_level=6, check_every=100, wal=True):
+        self.filename = filename
+        self.wal = wal
+        self.ttl = ttl
+        self.max_size = max_size
+        self.compress_level = compress_level
+        self.check_every = check_every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = self.misses = self.evictions = 0
+        # one process at a time: a connection opened while another process
+        # creates the database fails with "database schema has changed"
+        with file_lock(filename):
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT PRIMARY KEY,
+                    value BLOB,
+                    meta TEXT,
+                    size INTEGER NOT NULL,
+                    fetched REAL NOT NULL,
+                    accessed REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed);
+            """)
+
+    @property
+    def conn(self):
+        """The connection of the current thread"""
+        try:
+            return self._local.conn
+        except AttributeError:
+            conn = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=%s'
+                         % ('WAL' if self.wal else 'DELETE'))
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            return conn
+
+    def serialize(self, value):
+        return sqlite3.Binary(zlib.compress(
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.compress_level))
+
+    def deserialize(self, value):
+        return pickle.loads(zlib.decompress(value))
+
+    def is_fresh(self, fetched):
+        return self.ttl is None or time.time() - fetched < self.ttl
+
+    def __nonzero__(self):
+        # Download checks ``if self.cache``, an empty cache is still a cache
+        return True
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def __iter__(self):
+        for row in self.conn.execute('SELECT key FROM pages'):
+            yield row[0]
+
+    def __contains__(self, url):
+        row = self.conn.execute('SELECT fetched FROM pages WHERE key=?',
+                                (normalize_url(url),)).fetchone()
+        return row is not None and self.is_fresh(row[0])
+
+    def __getitem__(self, url):
+        key = normalize_url(url)
+        row = self.conn.execute('SELECT value, fetched FROM pages WHERE key=?',
+                                (key,)).fetchone()
+        if row is None or not self.is_fresh(row[1]):
+            self.misses += 1
+            raise KeyError(url)
+        self.hits += 1
+        self.conn.execute('UPDATE pages SET accessed=? WHERE key=?',
+                          (time.time(), key))
+        return self.deserialize(row[0])
+
+    def __setitem__(self, url, value):
+        self.set(url, value)
+
+    def set(self, url, value, meta=None, fetched=None):
+        now = time.time()
+        data = self.serialize(value)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO pages '
+            '(key, value, meta, size, fetched, accessed) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (normalize_url(url), data, json.dumps(meta or {}), len(data),
+             fetched or now, now))
+        with self._lock:
+            self._writes += 1
+            check = self.max_size and self._writes % self.check_every == 0
+        if check:
+            self.evict()
+
+    def __delitem__(self, url):
+        self.conn.execute('DELETE FROM pages WHERE key=?',
+                          (normalize_url(url),))
+
+    def get(self, url, default=None):
+        try:
+            return self[url]
+        except KeyError:
+            return default
+
+    def meta(self, url, value=None):
+        """Get the meta data dict of ``url``, or set it when ``value`` is
+        given (same as pdict)
+        """
+        key = normalize_url(url)
+        if value is None:
+            row = self.conn.execute('SELECT meta FROM pages WHERE key=?',
+                                    (key,)).fetchone()
+            if row is None:
+                raise KeyError(url)
+            return json.loads(row[0])
+        self.conn.execute('UPDATE pages SET meta=? WHERE key=?',
+                          (json.dumps(value), key))
+
+    def fetched(self, url):
+        """When ``url`` was downloaded, as a timestamp, None if not cached
+        """
+        row = self.conn.execute('SELECT fetched FROM pages WHERE key=?',
+                                (normalize_url(url),)).fetchone()
+        return row and row[0]
+
+    def size(self):
+        """Total size of the compressed values"""
+        return self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    def evict(self):
+        """Remove the least recently read entries beyond ``max_size``
+        """
+        if not self.max_size:
+            return
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+        keys = []
+        rows = self.conn.execute(
+            'SELECT key, size FROM pages ORDER BY accessed')
+        for key, size in rows:
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.conn.executemany('DELETE FROM pages WHERE key=?', keys)
+        self.evictions += len(keys)
+
+    def import_pdict(self, filename):
+        """Copy the entries of a webscraping pdict cache file
+
+        Returns the number of entries imported.
+        """
+        from webscraping import pdict
+        old = pdict.PersistentDict(filename)
+        count = 0
+        self.conn.execute('BEGIN')
+        try:
+            for key in old:
+                entry = old.get(key)
+                if entry:
+                    updated = time.mktime(entry['updated'].timetuple())
+                    self.set(key, entry['value'], meta=entry['meta'] or {},
+                             fetched=updated)
+                    count += 1
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        return count
+
+
+def open_cache(filename, legacy=None, **kwargs):
+    """Open the PageCache at ``filename``, importing the pdict cache file
+    ``legacy`` the first time
+    """
+    if not legacy:
+        return PageCache(filename, **kwargs)
+    # the processes started together wait for the first one to import it
+    # (a lock of its own: releasing the lock of ``filename`` taken again
+    # by PageCache would release it for the whole process)
+    with file_lock(legacy):
+        exists = os.path.exists(filename)
+        cache = PageCache(filename, **kwargs)
+        if not exists and os.path.exists(legacy):
+            print('Importing %s into %s' % (legacy, filename))
+            print('%d pages imported' % cache.import_pdict(legacy))
+    return cache
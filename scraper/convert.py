@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Conversion of the extracted articles to rst, in a process pool."""
+import collections
+import HTMLParser
+import multiprocessing
+import signal
+import time
+
+from creole import html2rest
+
+from scraper.fetch import WAIT_TIMEOUT
+from scraper.metrics import null_metrics
+
+
+TMP = u"""\
+%(title)s
+%(title_under)s
+
+:date: %(date)s
+:category: Résultats
+:summary: %(title)s
+
+%(content)s
+"""
+
+_h = HTMLParser.HTMLParser()
+
+def html2text(html):
+    return _h.unescape(html)
+
+
+def render(article, urls=None):
+    """Return the rst page of an Article
+
+    urls:
+        maps the URL of images (or links) of the content to the URL to use
+        in the page instead, applied by the emitter to each image and link
+        as it is written
+    """
+    data = {}
+    data['title'] = article.title
+    data['title_under'] = '=' * len(data['title'])
+    data['date'] = article.date
+    content = html2text(article.content)
+    url_map = None
+    if urls:
+        # the parser sees the URLs unescaped, like the rest of the content
+        urls = dict((html2text(url), local) for url, local in urls.items())
+        url_map = lambda url: urls.get(url.strip(), url)
+    data['content'] = html2rest(content, url_map=url_map)
+    return TMP % data
+
+
+def _timed_render(article, urls):
+    # timed in the worker, the time spent queued is not conversion time
+    start = time.time()
+    page = render(article, urls)
+    return page, time.time() - start
+
+
+def _init_worker():
+    # let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ConversionPool(object):
+    """Render articles in worker processes
+
+    ``submit()`` returns immediately; the callback of each article is
+    called in the calling process, in submission order, with the rendered
+    page. At most ``window`` articles are in flight, ``submit()`` waits for
+    the oldest ones beyond that.
+
+    The pool forks its workers when created, so create it before starting
+    any thread.
+
+    num_workers:
+        number of processes, all the CPUs by default. With 0 the articles
+        are rendered inline.
+    window:
+        maximum number of articles being converted
+    metrics:
+        Metrics receiving the duration of each conversion, or None
+    """
+
+    def __init__(self, num_workers=None, window=None, metrics=None):
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        if num_workers:
+            self.pool = multiprocessing.Pool(num_workers, _init_worker)
+        else:
+            self.pool = None
+        self.window = window or 4 * max(1, num_workers)
+        self._pending = collections.deque()
+        self.num_failures = 0
+        self.metrics = metrics or null_metrics
+
+    def submit(self, article, callback, urls=None, errback=None):
+        """Render ``article`` with ``urls`` (see ``render()``), then call
+        ``callback`` with the page, or ``errback`` with the error
+        """
+        if self.pool is None:
+            self._done(article, callback, errback,
+                       lambda: _timed_render(article, urls))
+            return
+        result = self.pool.apply_async(_timed_render, (article, urls))
+        self._pending.append((article, callback, errback, result))
+        self._collect(self.window)
+
+    def _collect(self, limit):
+        """Hand finished pages to their callback, and wait for the oldest
+        ones while more than ``limit`` are pending
+        """
+        while self._pending:
+            article, callback, errback, result = self._pending[0]
+            if len(self._pending) <= limit and not result.ready():
+                break
+            self._pending.popleft()
+            self._done(article, callback, errback,
+                       lambda: result.get(WAIT_TIMEOUT))
+
+    def _done(self, article, callback, errback, get_page):
+        try:
+            page, elapsed = get_page()
+        except Exception as e:
+            # html2rest chokes on some markup, do not lose the whole run
+            self.num_failures += 1
+            self.metrics.count('conversions failed')
+            print('Failed to convert %s: %r' % (article.url, e))
+            if errback is not None:
+                errback(e)
+        else:
+            self.metrics.add('convert', elapsed)
+            callback(page)
+
+    def flush(self):
+        """Wait for the articles submitted so far to be converted"""
+        self._collect(0)
+
+    def close(self):
+        """Wait for all the articles to be converted
+        """
+        self.flush()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
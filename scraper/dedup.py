@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""Detection of articles published several times, exactly or nearly."""
+import hashlib
+import json
+import re
+import threading
+
+from scraper.convert import html2text
+from scraper.utils import atomic_write, file_lock, load_json, merge_changes
+
+# bump when fingerprint() changes: the duplicates found by another version
+# are checked again
+FINGERPRINT_VERSION = 2
+
+# words of a shingle, and distinct shingles a text needs to be compared by
+# similarity (below, a few different words weigh too much: short texts are
+# only compared exactly)
+SHINGLE_SIZE = 4
+MIN_SHINGLES = 40
+
+# words a text needs to be compared at all: "See the results" or a photo
+# caption says nothing of the article, which is its title, images and links
+MIN_WORDS = 20
+
+# the minhash signature is cut in BANDS bands of ROWS values; two
+# signatures sharing a band are candidates, which finds the texts more than
+# about 80% similar with little chance of missing one
+BANDS = 16
+ROWS = 4
+NUM_HASHES = BANDS * ROWS
+
+# one hash per shingle, combined with these masks to get NUM_HASHES
+# independent ones
+_masks = [int(hashlib.md5(b'mask%d' % i).hexdigest()[:8], 16)
+          for i in range(NUM_HASHES)]
+
+_tag_regex = re.compile(r'<[^>]*>')
+_href_regex = re.compile(r"""\shref\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""",
+                         re.IGNORECASE)
+_word_regex = re.compile(r'\w+', re.UNICODE)
+
+
+def words(html):
+    """Lower cased words of the text of ``html``"""
+    return _word_regex.findall(html2text(_tag_regex.sub(' ', html)).lower())
+
+
+def minhash(features):
+    """MinHash signature of the set of ``features`` strings
+
+    The share of equal values of the signatures of two sets estimates their
+    Jaccard similarity.
+    """
+    hashes = [int(hashlib.md5(feature).hexdigest()[:8], 16)
+              for feature in features]
+    return [min(h ^ mask for h in hashes) for mask in _masks]
+
+
+def similarity(a, b):
+    """Estimated similarity of the sets of the signatures ``a`` and ``b``
+    """
+    return sum(x == y for x, y in zip(a, b)) / float(len(a))
+
+
+def links(html):
+    """The href of the links of ``html``, stripped"""
+    return [href.strip('\'"').strip() for href in _href_regex.findall(html)]
+
+
+def fingerprint(record):
+    """Return the exact hash and the MinHash signature of the Article
+    ``record``, None when its text is too short to compare
+
+    Both cover the words of the title and of the body, and the images and
+    links of the body: articles with the same text but other pictures or
+    documents are different articles. Markup, case, punctuation and spacing
+    do not change them.
+    """
+    text = words(record.content)
+    if len(text) < MIN_WORDS:
+        return None, None
+    features = set(' '.join(text[i:i + SHINGLE_SIZE]).encode('utf8')
+                   for i in range(max(1, len(text) - SHINGLE_SIZE + 1)))
+    num_shingles = len(features)
+    title = ' '.join(words(record.title))
+    references = ['img:' + src for src in record.images] + \
+        ['a:' + href for href in links(record.content)]
+    features.add(('title:' + title).encode('utf8'))
+    features.update(reference.encode('utf8') for reference in references)
+    exact = hashlib.sha1('\n'.join(
+        [title, ' '.join(text)] + sorted(set(references))).encode('utf8')
+    ).hexdigest()
+    if num_shingles < MIN_SHINGLES:
+        return exact, None
+    return exact, minhash(features)
+
+
+def _bands(signature):
+    return ['%d:%s' % (i, '.'.join(
+        '%x' % value for value in signature[i * ROWS:(i + 1) * ROWS]))
+        for i in range(BANDS)]
+
+
+class FingerprintIndex(object):
+    """Fingerprints of the articles converted, stored as JSON, to find the
+    new articles that repeat one of them
+
+    An article is a duplicate of an earlier one when their titles, texts,
+    images and links are the same, or at least ``min_similarity`` similar
+    (a repost with a few words changed, or with a different layout): the
+    Jaccard similarity of their sets of shingles, images and links,
+    estimated from their MinHash signatures. Articles with little text are
+    never duplicates.
+
+    The duplicates found by another FINGERPRINT_VERSION are in
+    ``recheck``, to be processed again. Several processes can share the
+    index: each save merges the file with the articles the others saved.
+
+    filename:
+        where the index is stored
+    min_similarity:
+        similarity of near duplicates, 1 to only find exact duplicates
+    save_every:
+        save after this many changes, so a crash loses little
+    """
+
+    def __init__(self, filename='fingerprints.json', min_similarity=0.8,
+                 save_every=50):
+        self.filename = filename
+        self.min_similarity = min_similarity
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        # URLs added since the last save
+        self._changed_entries = set()
+        self._changed_duplicates = set()
+        self._unsaved = 0
+        data = load_json(filename)
+        # url -> {'hash', 'minhash', 'filename'} of the original articles
+        self.entries = data.get('articles', {})
+        # url -> url of the article it duplicates
+        self.duplicates = data.get('duplicates', {})
+        self.recheck = set()
+        if data.get('version') != FINGERPRINT_VERSION:
+            # the fingerprints of the originals no longer match, only the
+            # duplicates are kept until their articles are done again
+            self.entries = {}
+            self.recheck = set(self.duplicates)
+        self._exact = {}
+        self._bands = {}
+        for url, entry in self.entries.items():
+            self._index(url, entry)
+
+    def _index(self, url, entry):
+        if entry['hash'] is None:
+            return
+        self._exact[entry['hash']] = url
+        if entry['minhash'] is not None:
+            for band in _bands(entry['minhash']):
+                self._bands.setdefault(band, set()).add(url)
+
+    def _unindex(self, url, entry):
+        if entry['hash'] is None:
+            return
+        if self._exact.get(entry['hash']) == url:
+            del self._exact[entry['hash']]
+        if entry['minhash'] is not None:
+            for band in _bands(entry['minhash']):
+                self._bands[band].discard(url)
+
+    def find(self, url, fingerprint):
+        """Return the URL of the article ``url`` duplicates and whether it
+        is an exact duplicate, or (None, False)
+        """
+        exact, near = fingerprint
+        if exact is None:
+            return None, False
+        with self._lock:
+            original = self._exact.get(exact)
+            if original is not None and original != url:
+                return original, True
+            if near is None or self.min_similarity >= 1:
+                return None, False
+            candidates = set()
+            for band in _bands(near):
+                candidates.update(self._bands.get(band, ()))
+            candidates.discard(url)
+            best = None
+            for candidate in candidates:
+                score = similarity(near, self.entries[candidate]['minhash'])
+                if score >= self.min_similarity and \
+                        (best is None or score > best[0]):
+                    best = score, candidate
+            return (best[1] if best else None), False
+
+    def add(self, url, fingerprint, filename):
+        """Record ``url`` as an original article, written to ``filename``
+        """
+        exact, near = fingerprint
+        entry = {'hash': exact, 'minhash': near, 'filename': filename}
+        with self._lock:
+            self.duplicates.pop(url, None)
+            self._changed_duplicates.discard(url)
+            self.recheck.discard(url)
+            if url in self.entries:
+                self._unindex(url, self.entries[url])
+            self.entries[url] = entry
+            self._index(url, entry)
+            self._changed_entries.add(url)
+            self._changed()
+
+    def add_duplicate(self, url, original):
+        with self._lock:
+            self.duplicates[url] = original
+            self.recheck.discard(url)
+            self._changed_duplicates.add(url)
+            self._changed()
+
+    def _changed(self):
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        with file_lock(self.filename):
+            saved = load_json(self.filename)
+            if saved.get('version') != FINGERPRINT_VERSION:
+                saved = {'version': FINGERPRINT_VERSION,
+                         'duplicates': saved.get('duplicates', {})}
+            articles = saved.setdefault('articles', {})
+            duplicates = saved.setdefault('duplicates', {})
+            entries = dict(self.entries)
+            for url in merge_changes(self.entries, articles,
+                                     self._changed_entries):
+                if url in entries:
+                    self._unindex(url, entries[url])
+                self._index(url, self.entries[url])
+                self.recheck.discard(url)
+            # the duplicates found to be originals since
+            for url in self._changed_entries:
+                duplicates.pop(url, None)
+            for url in merge_changes(self.duplicates, duplicates,
+                                     self._changed_duplicates):
+                self.recheck.discard(url)
+            atomic_write(self.filename, json.dumps(saved, indent=1,
+                                                   sort_keys=True))
+        self._changed_entries.clear()
+        self._changed_duplicates.clear()
+        self._unsaved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
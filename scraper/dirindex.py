@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""In memory listing of the output directories."""
+import os
+import threading
+
+
+class DirectoryIndex(object):
+    """Names of the files in a directory, listed once and kept up to date
+    by the writers, so that checking whether a file exists costs no
+    filesystem access (the output directories may be network mounts)
+
+    Each name can be claimed by the key (article or image URL) it is
+    written for, so two keys wanting the same name are detected instead of
+    the second one overwriting the file of the first.
+
+    directory:
+        the directory to index, created if missing
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.owners = {}
+        try:
+            self.names = set(os.listdir(directory))
+        except OSError:
+            os.makedirs(directory)
+            self.names = set()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self, path):
+        """Same as ``os.path.exists``, from the index for the files of the
+        directory
+        """
+        dirname, name = os.path.split(path)
+        if os.path.normpath(dirname) == os.path.normpath(self.directory):
+            return name in self.names
+        return os.path.exists(path)
+
+    def add(self, name):
+        """Record that ``name`` was written"""
+        with self._lock:
+            self.names.add(name)
+
+    def claim(self, name, owner):
+        """Reserve ``name`` for ``owner``
+
+        Returns False if another owner already has it.
+        """
+        with self._lock:
+            current = self.owners.setdefault(name, owner)
+        return current == owner
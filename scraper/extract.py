@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Single pass extraction of the fields of an over-blog article page."""
+import collections
+import re
+
+
+class Article(collections.namedtuple('Article',
+                                     'url title date content images')):
+    """An extracted article
+
+    url:
+        the article page
+    title:
+        inner HTML of the title link
+    date:
+        'YYYY-MM-DD HH:MM'
+    content:
+        inner HTML of the article body, stripped
+    images:
+        the src of the images in the body, stripped, in order, without
+        duplicates. Like the body they are raw HTML, entities are not
+        decoded.
+    """
+    __slots__ = ()
+
+
+# the spans holding the date, in the order of the fields of Article.date
+DATE_CLASSES = ('day', 'month', 'year', 'hour')
+FIELDS = ('title', 'content') + DATE_CLASSES
+
+# one token per tag; comments and scripts are consumed whole so that
+# markup inside them is not mistaken for tags
+_tag_regex = re.compile(r"""
+    <!--.*?-->
+    | <script\b.*?</script\s*>
+    | <(?P<end>/?)(?P<tag>[a-zA-Z][\w:]*)(?P<attrs>(?:"[^"]*"|'[^']*'|[^'">])*)>
+""", re.DOTALL | re.IGNORECASE | re.VERBOSE)
+_class_regex = re.compile(r"""\sclass\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""",
+                          re.IGNORECASE)
+_src_regex = re.compile(r"""\ssrc\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""",
+                        re.IGNORECASE)
+
+
+def _attribute(regex, attrs):
+    match = regex.search(attrs)
+    if match:
+        return match.group(1).strip('\'"')
+
+
+def _field(tag, cls):
+    cls = cls.lower()
+    if tag == 'a' and cls == 'titrearticle':
+        return 'title'
+    elif tag == 'div' and cls == 'contenuarticle':
+        return 'content'
+    elif tag == 'span' and cls in DATE_CLASSES:
+        return cls
+
+
+def scan_article(page):
+    """Return the raw inner HTML of the title, date spans and body of an
+    article page, and the src of the images of the body
+
+    The page is tokenized once with a single regex, and scanning stops as
+    soon as every field has been found. Like the XPath searches it
+    replaces, only the first element of each kind is kept.
+    """
+    fields = {}
+    images = []
+    open_field = None  # (field, tag, inner start offset, depth)
+    for match in _tag_regex.finditer(page):
+        tag = match.group('tag')
+        if tag is None:
+            # comment or script
+            continue
+        tag = tag.lower()
+        is_end = match.group('end')
+
+        if open_field is None:
+            if is_end or tag not in ('a', 'div', 'span'):
+                continue
+            cls = _attribute(_class_regex, match.group('attrs'))
+            field = cls and _field(tag, cls)
+            if field and field not in fields:
+                open_field = field, tag, match.end(), 1
+            continue
+
+        field, open_tag, start, depth = open_field
+        if field == 'content' and tag == 'img' and not is_end:
+            src = _attribute(_src_regex, match.group('attrs'))
+            src = src and src.strip()
+            if src and src not in images:
+                images.append(src)
+        if tag != open_tag or match.group('attrs').endswith('/'):
+            continue
+        if not is_end:
+            open_field = field, open_tag, start, depth + 1
+        elif depth > 1:
+            open_field = field, open_tag, start, depth - 1
+        else:
+            fields[field] = page[start:match.start()]
+            open_field = None
+            if len(fields) == len(FIELDS):
+                break
+    return fields, images
+
+
+def extract_article(url, page):
+    """Return the Article of an over-blog article page (unicode)
+
+    Raises ValueError when a field is missing.
+    """
+    fields, images = scan_article(page)
+    missing = [name for name in FIELDS if name not in fields]
+    if missing:
+        raise ValueError('%s: missing %s' % (url, ', '.join(missing)))
+
+    day = int(fields['day'])
+    month = int(fields['month'][-2:])
+    year = int(fields['year'][-4:])
+    date = '%d-%.2d-%.2d %s' % (year, month, day, fields['hour'])
+    content = fields['content'].strip()
+    return Article(url=url, title=fields['title'], date=date, content=content,
+                   images=[src for src in images if src in content])
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""Concurrent page fetching on top of webscraping's Download.
+
+Every worker thread owns its own ``download.Download`` instance (the pdict
+cache holds a sqlite connection, which cannot be shared between threads),
+all of them pointing at the same cache file, so cache and retry semantics
+are the ones of a plain ``D.get()``.
+"""
+import collections
+import cookielib
+import email.utils
+import httplib
+import itertools
+import logging
+import socket
+import threading
+import time
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+from webscraping import common, download
+
+from scraper.metrics import null_metrics
+
+
+# AsyncResult.get() without a timeout cannot be interrupted by Ctrl-C on
+# Python 2, so always wait with a (very long) timeout.
+WAIT_TIMEOUT = 60 * 60 * 24
+
+
+def validators(headers):
+    """ETag and Last-Modified of a response, from its headers (any
+    mapping with lower case keys, or a mimetools.Message)
+    """
+    found = {}
+    for name, key in (('etag', 'etag'), ('last-modified', 'last_modified')):
+        value = headers.get(name)
+        if value:
+            found[key] = value
+    return found
+
+
+def retry_after(headers):
+    """Seconds to wait before trying again according to the Retry-After
+    of a response (in seconds or as a date), None when there is none
+    """
+    value = (headers.get('retry-after') or '').strip()
+    if value.isdigit():
+        return int(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+def conditional_headers(validators):
+    """Request headers revalidating a response with these validators"""
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+class NotModified(str):
+    """Cached page the server answered 304 Not Modified for"""
+
+
+class _Body(object):
+    """File-like wrapper that keeps the connection alive once read fully.
+
+    httplib closes a response by itself when its body has been consumed; a
+    response closed before that still has unread bytes on the socket, so
+    the connection has to be dropped instead of being reused.
+    """
+
+    def __init__(self, conn, response):
+        self.conn = conn
+        self.response = response
+
+    def recv(self, amt=None):
+        return self.response.read(amt)
+
+    read = recv
+
+    def close(self):
+        if not self.response.isclosed():
+            self.conn.close()
+        self.response.close()
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """urllib2 handler reusing one HTTP/1.1 connection per host and thread.
+
+    urllib2 forces ``Connection: close`` on every request, so each page
+    costs a TCP (and TLS) handshake. This handler keeps the connections in
+    thread local storage, and transparently reconnects when the server
+    closed an idle connection.
+    """
+
+    def __init__(self, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self._local = threading.local()
+
+    def _connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            self._local.connections = {}
+            return self._local.connections
+
+    def http_open(self, req):
+        return self.do_keepalive_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.do_keepalive_open(httplib.HTTPSConnection, req)
+
+    def do_keepalive_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        connections = self._connections()
+        key = (http_class, host)
+        conn = connections.get(key)
+        reused = conn is not None
+        if conn is None:
+            conn = connections[key] = http_class(host, timeout=req.timeout)
+            conn.set_debuglevel(self._debuglevel)
+
+        try:
+            conn.request(req.get_method(), req.get_selector(), req.data,
+                         headers)
+            response = conn.getresponse(buffering=True)
+        except (socket.error, httplib.HTTPException) as err:
+            conn.close()
+            del connections[key]
+            if reused:
+                # the server dropped the idle connection, try a fresh one
+                return self.do_keepalive_open(http_class, req)
+            raise urllib2.URLError(err)
+
+        fp = socket._fileobject(_Body(conn, response), close=True)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+def build_opener():
+    """Same opener as webscraping's common.build_opener, with keep-alive
+    """
+    return urllib2.build_opener(
+        urllib2.HTTPCookieProcessor(cookielib.CookieJar()),
+        KeepAliveHandler())
+
+
+class _NotModifiedFilter(logging.Filter):
+    """Drop the "Download error: <url> 304" warnings of Download
+
+    Only the conditional requests of ``PageFetcher.revalidate()`` get a
+    304, which is not an error. A filter rather than a logger silenced
+    during the request, so the real errors of the other threads still get
+    through.
+    """
+
+    def filter(self, record):
+        message = record.getMessage()
+        return not (message.startswith('Download error: ')
+                    and message.endswith(' 304'))
+
+
+_not_modified_filter = _NotModifiedFilter()
+
+
+class PageFetcher(object):
+    """Download pages with a bounded pool of worker threads
+
+    num_workers:
+        how many pages are downloaded at the same time
+    window:
+        how many pages may be fetched ahead of the consumer, defaults to
+        twice the number of workers
+    metrics:
+        Metrics receiving the duration of each page, or None
+    stage:
+        name of the stage these pages are timed under
+    refresh:
+        revalidate the cached pages with a conditional request instead of
+        using them as they are; pages the server did not change are
+        returned as NotModified instances
+    kwargs:
+        passed to ``download.Download`` for each worker
+    """
+
+    def __init__(self, num_workers=4, window=None, metrics=None,
+                 stage='fetch', refresh=False, **kwargs):
+        self.num_workers = max(1, num_workers)
+        self.window = window or 2 * self.num_workers
+        self.metrics = metrics or null_metrics
+        self.stage = stage
+        self.refresh = refresh
+        if refresh and _not_modified_filter not in common.logger.filters:
+            common.logger.addFilter(_not_modified_filter)
+        self.cache = kwargs.get('cache')
+        self.kwargs = kwargs
+        self._local = threading.local()
+        self._worker_ids = itertools.count()
+
+    def downloader(self):
+        """Return the Download instance of the current thread
+        """
+        try:
+            return self._local.D
+        except AttributeError:
+            kwargs = dict(self.kwargs)
+            kwargs.setdefault('opener', build_opener())
+            # throttle each worker on its own, otherwise the per domain
+            # delay serializes all of them again
+            kwargs.setdefault('throttle_additional_key',
+                              'worker-%d' % next(self._worker_ids))
+            self._local.D = download.Download(**kwargs)
+            return self._local.D
+
+    def get(self, url):
+        with self.metrics.time(self.stage):
+            if self.refresh:
+                return self.revalidate(url)
+            D = self.downloader()
+            html = D.get(url)
+            if html and D.num_downloads:
+                self._save_validators(url, D.response_headers)
+            return html
+
+    def revalidate(self, url):
+        """Download ``url`` again unless the cached copy is still current
+        """
+        D = self.downloader()
+        cached = headers = None
+        if self.cache is not None:
+            cached = self.cache.get(url)
+        if cached:
+            try:
+                headers = conditional_headers(self.cache.meta(url))
+            except KeyError:
+                pass
+        # Download does not cache 304 responses sensibly (and retries
+        # them), so retry and cache here
+        for attempt in range(self.kwargs.get('num_retries', 0) + 1):
+            html = D.get(url, read_cache=False, write_cache=False,
+                         headers=headers, num_retries=0)
+            if D.response_code == '304' and cached:
+                self.metrics.count('pages not modified')
+                return NotModified(cached)
+            if html or D.response_code.startswith('4'):
+                break
+        if html and self.cache is not None:
+            self.cache[url] = html
+            self._save_validators(url, D.response_headers)
+        return html
+
+    def _save_validators(self, url, headers):
+        if self.cache is None:
+            return
+        found = validators(headers)
+        if found:
+            try:
+                meta = self.cache.meta(url)
+            except KeyError:
+                return
+            meta.update(found)
+            self.cache.meta(url, meta)
+
+    def imap(self, urls):
+        """Yield ``(url, html)`` for each url, in the order of ``urls``
+
+        At most ``window`` pages are held in memory waiting for the
+        consumer.
+        """
+        pool = ThreadPool(self.num_workers)
+        pending = collections.deque()
+        try:
+            for url in urls:
+                pending.append((url, pool.apply_async(self.get, (url,))))
+                if len(pending) >= self.window:
+                    url, result = pending.popleft()
+                    yield url, result.get(WAIT_TIMEOUT)
+            while pending:
+                url, result = pending.popleft()
+                yield url, result.get(WAIT_TIMEOUT)
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Parallel image downloads with keep-alive connections."""
+import httplib
+import os
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+from scraper.fetch import (WAIT_TIMEOUT, build_opener, conditional_headers,
+                           retry_after, validators)
+from scraper.metrics import null_metrics
+from scraper.scheduler import Deferred, HostDown, HostScheduler
+from scraper.utils import mkstemp
+from scraper.workqueue import BUSY, DONE, FAILED
+
+CHUNK_SIZE = 64 * 1024
+
+# 4xx codes that do not mean the image is gone: Request Timeout, Too Many
+# Requests
+TRANSIENT_CODES = (408, 429)
+
+
+class TransientError(IOError):
+    """Download failed but may work on a later attempt, not before
+    ``retry_after`` seconds when the server said so
+    """
+
+    def __init__(self, message, retry_after=None):
+        IOError.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class FailedElsewhere(IOError):
+    """Download failed in another worker of the queue"""
+
+
+def _discard(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class ImageDownloader(object):
+    """Download images in the background with a bounded number of transfers
+
+    The transfers are scheduled per host (see HostScheduler): each image
+    host has its own queue, rate limit and adaptive concurrency, and a host
+    that keeps failing or answering slowly is circuit broken then given up,
+    without stalling the downloads from the other hosts.
+
+    Each transfer streams into a temporary file in the store directory,
+    which is handed to the ImageStore only once complete, so an
+    interrupted download never leaves a file that looks done.
+
+    Errors meaning the image is gone (4xx, unknown host, bad URL) are not
+    retried and the URL is recorded in ``lost``; network errors, 5xx, 408
+    and 429 responses are retried ``num_retries`` times with exponential
+    backoff (or after their Retry-After), then reported as failures
+    without being recorded, so the next run tries again.
+
+    An image already in the store is revalidated with its ETag and
+    Last-Modified, and only downloaded again if it changed.
+
+    With a ``queue``, a new image is only downloaded by the worker that
+    claims it first; the other workers wait for it and use the blob name it
+    got, the blobs being named after their content.
+
+    store:
+        the ImageStore receiving the downloaded images
+    num_workers:
+        the maximum number of concurrent transfers
+    timeout:
+        socket timeout in seconds for each request
+    num_retries:
+        how many times a transient error is retried
+    retry_delay:
+        seconds to wait before the first retry, doubled for each retry
+    rate:
+        maximum requests per second to each host, None for no limit
+    max_per_host:
+        maximum number of concurrent transfers from one host
+    lost:
+        a LostImages registry, or None
+    metrics:
+        Metrics receiving the duration of each download, or None
+    queue:
+        WorkQueue shared with the other scraper processes, or None
+    queue_poll:
+        seconds between two checks of an image another worker downloads
+    """
+
+    def __init__(self, store, num_workers=4, timeout=30, num_retries=2,
+                 retry_delay=1, rate=None, max_per_host=4, lost=None,
+                 metrics=None, queue=None, queue_poll=2):
+        self.store = store
+        self.queue = queue
+        self.queue_poll = queue_poll
+        self.num_workers = max(1, num_workers)
+        self.timeout = timeout
+        self.lost = lost
+        self.metrics = metrics or null_metrics
+        self.opener = build_opener()
+        self.scheduler = HostScheduler(
+            self.num_workers, rate=rate, max_per_host=max_per_host,
+            num_retries=num_retries, retry_delay=retry_delay,
+            slow=timeout / 2.0, transient=(TransientError,))
+        # reentrant: a request to a broken host fails within submit()
+        self._lock = threading.RLock()
+        self._pending = {}  # url -> Task
+        self.num_downloads = self.num_bytes = 0
+        self.failures = []  # (url, error)
+        self.started = self.finished = None
+
+    def submit(self, url):
+        """Queue ``url`` to be downloaded into the store
+
+        Returns a Task whose ``get()`` gives the blob name, or None when the
+        download failed. An image already queued is not queued twice.
+        """
+        with self._lock:
+            if self.started is None:
+                self.started = time.time()
+            result = self._pending.get(url)
+            if result is None:
+                download = self.download
+                if self.queue is not None and self.store.lookup(url) is None:
+                    download = self.download_queued
+                result = self._pending[url] = self.scheduler.submit(
+                    url, download, self._failed)
+            return result
+
+    def download(self, url):
+        """Make one attempt at downloading ``url`` into the store
+
+        Returns the blob name, raises like ``fetch()``.
+        """
+        with self.metrics.time('images'):
+            name, size = self.fetch(url)
+        if size is None:
+            self.metrics.count('images not modified')
+        else:
+            self._record(size=size)
+        return name
+
+    def download_queued(self, url):
+        """``download()`` if this worker claims ``url`` in the queue, else
+        the blob name of the worker that did
+        """
+        state, value = self.queue.claim('image', url)
+        if state == BUSY:
+            raise Deferred(self.queue_poll)
+        if state == DONE:
+            self.metrics.count('images from other workers')
+            self.store.record(url, value)
+            return value
+        if state == FAILED:
+            raise FailedElsewhere(value)
+        try:
+            name = self.download(url)
+        except Exception as e:
+            self.queue.fail('image', url, str(e),
+                            retry=isinstance(e, TransientError))
+            raise
+        self.queue.done('image', url, name)
+        return name
+
+    def _failed(self, url, error):
+        """Record the failure of the last attempt at ``url``"""
+        if isinstance(error, (TransientError, HostDown, FailedElsewhere)):
+            print('Failed to download %s: %s' % (url, error))
+        elif isinstance(error, IOError):
+            print('Image does not exist anymore ' + url)
+            if self.lost is not None:
+                self.lost.add(url)
+        else:
+            print('Failed to download %s: %r' % (url, error))
+        self._record(failure=(url, str(error)))
+        return None
+
+    def fetch(self, url):
+        """Stream ``url`` into a temporary file and add it to the store
+
+        Returns the blob name and the number of bytes downloaded, None if
+        the stored image is still current. Raises TransientError for errors
+        worth retrying, and IOError when the image does not exist.
+        """
+        headers = {}
+        if self.store.lookup(url) is not None:
+            headers = conditional_headers(self.store.validators.get(url, {}))
+        request = urllib2.Request(urllib.quote(url, safe='/:?&+=%()'),
+                                  headers=headers)
+        fd, tmp = mkstemp(self.store.directory, '.download.')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                response = self.opener.open(request, timeout=self.timeout)
+                try:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        size += len(chunk)
+                finally:
+                    response.close()
+            # httplib does not complain when the connection is closed
+            # before the announced length has been read
+            length = response.info().getheader('Content-Length')
+            if length and length.isdigit() and int(length) != size:
+                raise TransientError('incomplete download: %d of %s bytes'
+                                     % (size, length))
+            name = self.store.add(url, tmp, validators(response.info()))
+        except urllib2.HTTPError as e:
+            _discard(tmp)
+            if e.code == 304:
+                return self.store.lookup(url), None
+            if e.code >= 500 or e.code in TRANSIENT_CODES:
+                raise TransientError(str(e), retry_after(e.info()))
+            raise IOError(str(e))
+        except urllib2.URLError as e:
+            _discard(tmp)
+            if isinstance(e.reason, (socket.timeout, socket.error)) \
+                    and not isinstance(e.reason, socket.gaierror):
+                raise TransientError(str(e))
+            raise IOError(str(e))
+        except (socket.error, httplib.HTTPException) as e:
+            _discard(tmp)
+            raise TransientError(str(e) or e.__class__.__name__)
+        except ValueError as e:
+            # urllib2 raises ValueError for URLs it cannot parse
+            _discard(tmp)
+            raise IOError(str(e))
+        except:
+            _discard(tmp)
+            raise
+        return name, size
+
+    def _record(self, size=0, failure=None):
+        with self._lock:
+            if failure:
+                self.failures.append(failure)
+            else:
+                self.num_downloads += 1
+                self.num_bytes += size
+        if failure:
+            self.metrics.count('images failed')
+        else:
+            self.metrics.count('images downloaded')
+            self.metrics.count('image bytes', size)
+
+    def join(self):
+        """Wait for all queued downloads
+        """
+        while True:
+            with self._lock:
+                results = list(self._pending.values())
+                self._pending.clear()
+            if not results:
+                break
+            for result in results:
+                result.get(WAIT_TIMEOUT)
+
+    def close(self):
+        self.join()
+        self.finished = time.time()
+        self.scheduler.close()
+
+    def report(self):
+        """Return a one line summary of the transfers
+        """
+        if self.started is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self.finished or time.time()) - self.started
+        rate = self.num_bytes / elapsed if elapsed else 0.0
+        report = ('Images: %d downloaded, %.1f KB in %.1fs (%.1f KB/s), '
+                  '%d failed' % (self.num_downloads, self.num_bytes / 1024.0,
+                                 elapsed, rate / 1024.0, len(self.failures)))
+        down = self.scheduler.hosts_down()
+        if down:
+            report += ', hosts given up: %s' % ', '.join(down)
+        return report
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.scheduler.terminate()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Concurrent listing of the monthly archive pages."""
+import HTMLParser
+import urlparse
+
+# the two classes over-blog alternates on the archive list items
+LIST_CLASSES = ('listArticles  article_item_even',
+                'listArticles  article_item_odd')
+
+# elements without a closing tag, they do not change the nesting depth
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'hr', 'img', 'input',
+                       'link', 'meta', 'param', 'source', 'wbr'])
+
+
+class ArchiveParser(HTMLParser.HTMLParser):
+    """Collect ``//li[@class=...]/a/@href`` for all LIST_CLASSES at once
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.links = dict((cls, []) for cls in LIST_CLASSES)
+        self._current = None  # links list of the <li> we are in
+        self._depth = 0  # nesting depth inside that <li>
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'li':
+            self._current = self.links.get(dict(attrs).get('class'))
+            self._depth = 0
+        elif self._current is not None:
+            if tag == 'a' and self._depth == 0:
+                href = dict(attrs).get('href')
+                if href is not None:
+                    self._current.append(href)
+            if tag not in VOID_TAGS:
+                self._depth += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'li':
+            self._current = None
+        elif self._current is not None and tag not in VOID_TAGS:
+            self._depth -= 1
+
+
+def parse_archive(html):
+    """Return the article links of an archive page, even items first
+    """
+    parser = ArchiveParser()
+    parser.feed(html)
+    parser.close()
+    links = []
+    for cls in LIST_CLASSES:
+        links.extend(parser.links[cls])
+    return links
+
+
+def archive_urls(domain, root, years):
+    for year in years:
+        for month in range(1, 13):
+            yield urlparse.urljoin(domain, root % (year, month))
+
+
+def list_articles(fetcher, domain, root, years):
+    """Fetch all monthly archive pages through ``fetcher`` and return the
+    article links, in (year, month, page) order
+    """
+    articles = []
+    for url, archive in fetcher.imap(archive_urls(domain, root, years)):
+        if not archive:
+            print('Failed on %s' % url)
+            continue
+        articles.extend(parse_archive(archive))
+    return articles
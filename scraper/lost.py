@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Registry of the image URLs that do not exist anymore."""
+import json
+import os
+import threading
+
+from scraper.utils import atomic_write, file_lock
+
+
+class LostImages(object):
+    """Set of lost image URLs backed by ``lost_images.json``
+
+    The JSON file is read once. URLs added during a run are appended to a
+    journal (one JSON string per line), and merged back into the JSON file
+    by ``compact()``, which happens when the registry is used as a context
+    manager and left. A journal left over by a crashed run is replayed on
+    load. ``add()`` can be called from several threads, and several
+    processes can share the registry.
+
+    filename:
+        the JSON list of lost URLs
+    journal:
+        where to append new URLs, ``<filename>.journal`` by default
+    """
+
+    def __init__(self, filename='lost_images.json', journal=None):
+        self.filename = filename
+        self.journal_filename = journal or filename + '.journal'
+        self._lock = threading.Lock()
+        self._urls = []  # file order, kept for the compacted file
+        self._lost = set()
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                try:
+                    urls = json.loads(f.read())
+                except ValueError:
+                    urls = []
+            self._extend(urls)
+
+        if os.path.exists(self.journal_filename):
+            urls = []
+            with open(self.journal_filename) as f:
+                for line in f:
+                    try:
+                        urls.append(json.loads(line))
+                    except ValueError:
+                        # line cut short by a crash
+                        continue
+            self._extend(urls)
+
+    def _extend(self, urls):
+        for url in urls:
+            if url not in self._lost:
+                self._lost.add(url)
+                self._urls.append(url)
+
+    def __contains__(self, url):
+        return url in self._lost
+
+    def __len__(self):
+        return len(self._lost)
+
+    def add(self, url):
+        """Record ``url`` as lost
+        """
+        with self._lock:
+            if url in self._lost:
+                return
+            self._lost.add(url)
+            self._urls.append(url)
+            # opened each time: another process may have compacted the
+            # journal meanwhile
+            with file_lock(self.filename):
+                with open(self.journal_filename, 'a') as journal:
+                    journal.write(json.dumps(url) + '\n')
+
+    def compact(self):
+        """Merge the journal into the JSON file
+        """
+        with self._lock, file_lock(self.filename):
+            if os.path.exists(self.journal_filename):
+                # with the URLs the other processes added
+                self._load()
+                atomic_write(self.filename, json.dumps(self._urls))
+                os.remove(self.journal_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.compact()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Persistent record of the articles already converted."""
+import hashlib
+import json
+import os
+import threading
+
+from scraper.utils import atomic_write, file_lock, load_json, merge_changes
+
+
+def content_hash(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class Manifest(object):
+    """Map each article URL to its output file, page hash and converter
+    version, stored as JSON
+
+    An article is done when its entry was written by the current converter
+    version and the output file still exists, which can be checked before
+    downloading or parsing anything.
+
+    filename:
+        where the manifest is stored
+    version:
+        the converter version, entries of other versions are redone
+    save_every:
+        save after this many new entries, so a crash loses little work
+    exists:
+        function checking that an output file exists
+
+    Several processes can share the manifest: each save merges the file
+    with the entries the others saved.
+    """
+
+    def __init__(self, filename='manifest.json', version=1, save_every=50,
+                 exists=os.path.exists):
+        self.filename = filename
+        self.version = version
+        self.save_every = save_every
+        self.exists = exists
+        self._lock = threading.Lock()
+        self._changed = set()  # URLs recorded since the last save
+        self.entries = load_json(filename)
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def is_done(self, url):
+        entry = self.entries.get(url)
+        return (entry is not None and entry['version'] == self.version
+                and self.exists(entry['filename']))
+
+    def record(self, url, filename, page_hash):
+        with self._lock:
+            self.entries[url] = {
+                'filename': filename,
+                'hash': page_hash,
+                'version': self.version,
+            }
+            self._changed.add(url)
+            if len(self._changed) >= self.save_every:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        with file_lock(self.filename):
+            saved = load_json(self.filename)
+            merge_changes(self.entries, saved, self._changed)
+            atomic_write(self.filename, json.dumps(saved, indent=1,
+                                                   sort_keys=True))
+        self._changed.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
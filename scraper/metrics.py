@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Timers and counters of the scraping stages."""
+import collections
+import json
+import math
+import threading
+import time
+
+from scraper.utils import atomic_write
+
+# stages in pipeline order, for the report
+STAGES = ['listing', 'fetch', 'extract', 'dedup', 'images', 'optimize',
+          'convert', 'write']
+
+
+def percentile(samples, p):
+    """``p``th percentile of the sorted ``samples`` (nearest rank)
+
+    >>> percentile([1, 2, 3, 4], 50), percentile([1, 2, 3, 4], 99)
+    (2, 4)
+    """
+    if not samples:
+        return 0.0
+    index = int(math.ceil(p / 100.0 * len(samples))) - 1
+    return samples[max(0, min(index, len(samples) - 1))]
+
+
+class _Timer(object):
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add(self.stage, time.time() - self.start)
+
+
+class Metrics(object):
+    """Durations of each stage and event counters of a run
+
+    Thread safe: fetch and image threads record into the same instance.
+
+        with metrics.time('extract'):
+            record = extract_article(url, page)
+        metrics.count('cache hits')
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = collections.defaultdict(list)
+        self.counters = collections.defaultdict(int)
+        self.started = time.time()
+
+    def time(self, stage):
+        """Context manager adding its duration to ``stage``"""
+        return _Timer(self, stage)
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def stages(self):
+        """Names of the timed stages, known ones first"""
+        known = [stage for stage in STAGES if stage in self.samples]
+        return known + sorted(set(self.samples) - set(known))
+
+    def summary(self, stage):
+        samples = sorted(self.samples[stage])
+        total = sum(samples)
+        return collections.OrderedDict([
+            ('count', len(samples)),
+            ('total', total),
+            ('mean', total / len(samples) if samples else 0.0),
+            ('p50', percentile(samples, 50)),
+            ('p99', percentile(samples, 99)),
+            ('max', samples[-1] if samples else 0.0),
+        ])
+
+    def report(self):
+        """Return the summary table, one line per stage then the counters
+        """
+        lines = ['%-10s %7s %9s %9s %9s %9s' % (
+            'stage', 'calls', 'total s', 'mean ms', 'p50 ms', 'p99 ms')]
+        for stage in self.stages():
+            s = self.summary(stage)
+            lines.append('%-10s %7d %9.2f %9.2f %9.2f %9.2f' % (
+                stage, s['count'], s['total'], 1000 * s['mean'],
+                1000 * s['p50'], 1000 * s['p99']))
+        for name in sorted(self.counters):
+            lines.append('%-20s %d' % (name, self.counters[name]))
+        lines.append('%-20s %.2f' % ('elapsed s', time.time() - self.started))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('started', self.started),
+            ('elapsed', time.time() - self.started),
+            ('stages', collections.OrderedDict(
+                (stage, self.summary(stage)) for stage in self.stages())),
+            ('counters', dict(self.counters)),
+        ])
+
+    def save(self, filename):
+        """Write the JSON report to ``filename``"""
+        atomic_write(filename, json.dumps(self.to_dict(), indent=2))
+
+
+class _NullTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class NullMetrics(object):
+    """Metrics turned off: same interface, records nothing"""
+
+    enabled = False
+
+    def time(self, stage):
+        return _null_timer
+
+    def add(self, stage, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+
+null_metrics = NullMetrics()
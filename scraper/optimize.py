@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Recompression and resizing of the stored images for the asset mirror."""
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+from scraper.convert import _init_worker
+from scraper.dirindex import DirectoryIndex
+from scraper.fetch import WAIT_TIMEOUT
+from scraper.metrics import null_metrics
+from scraper.utils import atomic_write, file_lock, load_json, \
+    merge_changes, mkstemp
+
+# bump when optimize_image() changes, to process all the images again
+OPTIMIZER_VERSION = 1
+
+# formats not displayed by all browsers, converted to PNG (lossless, so
+# fine for whatever they hold)
+CONVERTED = dict.fromkeys(['.bmp', '.tif', '.tiff', '.ppm', '.pgm', '.pbm',
+                           '.rast', '.rgb', '.xbm'], '.png')
+
+# PIL format used to write each extension, the others are left as they are
+FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF'}
+
+# metrics counter of each status of optimize_image()
+COUNTERS = {'optimized': 'images optimized', 'kept': 'images kept as is',
+            'failed': 'images not optimized'}
+
+
+def optimized_name(name):
+    """Name of the optimized version of the blob ``name``
+
+    Only depends on the name, so articles can refer to the optimized image
+    before it is written.
+    """
+    stem, ext = os.path.splitext(name)
+    return stem + CONVERTED.get(ext.lower(), ext)
+
+
+def _recompress(source, ext, max_size, quality):
+    """Return the image ``source`` as ``ext`` bytes, downsized to fit in
+    ``max_size`` pixels, or None if it cannot be done
+    """
+    fmt = FORMATS.get(ext.lower())
+    if fmt is None:
+        return None
+    image = Image.open(source)
+    if getattr(image, 'is_animated', False):
+        # resizing would have to go through every frame, keep the
+        # animation as it is
+        return None
+    if hasattr(ImageOps, 'exif_transpose'):
+        # the EXIF orientation is lost on save, apply it to the pixels
+        image = ImageOps.exif_transpose(image)
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+    out = io.BytesIO()
+    if fmt == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(out, fmt, quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(out, fmt, optimize=True)
+    return out.getvalue()
+
+
+def optimize_image(source, target, max_size, quality):
+    """Write the optimized version of ``source`` to ``target``
+
+    The original is kept (hard linked, or copied) when recompressing does
+    not make it smaller, or fails, so ``target`` always exists afterwards.
+    Returns a (status, original size, size, seconds) tuple, status being
+    'optimized', 'kept' or 'failed'.
+    """
+    start = time.time()
+    original_size = os.path.getsize(source)
+    converted = os.path.splitext(source)[1] != os.path.splitext(target)[1]
+    try:
+        data = _recompress(source, os.path.splitext(target)[1], max_size,
+                           quality)
+        status = 'kept'
+    except Exception:
+        # truncated downloads, formats PIL cannot read...
+        data = None
+        status = 'failed'
+
+    fd, tmp = mkstemp(os.path.dirname(target), '.optimize.')
+    try:
+        if data is not None and (len(data) < original_size or converted):
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            status = 'optimized'
+            size = len(data)
+        else:
+            os.close(fd)
+            os.remove(tmp)
+            try:
+                os.link(source, tmp)
+            except (OSError, AttributeError):
+                shutil.copyfile(source, tmp)
+            size = original_size
+        os.rename(tmp, target)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return status, original_size, size, time.time() - start
+
+
+class ImageOptimizer(object):
+    """Optimized copies of the stored images, made in worker processes
+
+    Each blob of ``source_dir`` gets a version in ``source_dir/subdir``,
+    recompressed and downsized to fit in ``max_size`` pixels (animated GIFs
+    are only copied), so the pages can use the lighter image. The source ->
+    optimized mapping is saved to ``index``, together with the settings:
+    a blob already processed with the same settings is not processed
+    again.
+
+    ``submit()`` returns immediately with the name to use in the pages,
+    relative to ``source_dir``; the image is written in the background.
+
+    The pool forks its workers when created, so create it before starting
+    any thread. Needs Pillow.
+
+    max_size:
+        largest width or height of the optimized images, in pixels
+    quality:
+        JPEG quality of the recompressed images
+    num_workers:
+        number of processes, all the CPUs by default
+    metrics:
+        Metrics receiving the duration of each optimization, or None
+    """
+
+    def __init__(self, source_dir='images', subdir='optimized',
+                 index='optimized_images.json', max_size=1600, quality=85,
+                 num_workers=None, metrics=None):
+        if Image is None:
+            raise ImportError('Pillow is needed to optimize the images')
+        self.source_dir = source_dir
+        self.subdir = subdir
+        self.index = index
+        self.max_size = max_size
+        self.quality = quality
+        self.settings = {'max_size': max_size, 'quality': quality,
+                         'version': OPTIMIZER_VERSION}
+        self.files = DirectoryIndex(os.path.join(source_dir, subdir))
+        data = load_json(index)
+        if data.get('settings') == self.settings:
+            self.images = data['images']
+        else:
+            self.images = {}
+        self.metrics = metrics or null_metrics
+        self.pool = multiprocessing.Pool(num_workers, _init_worker)
+        self._pending = {}  # blob name -> AsyncResult
+        self.counts = dict.fromkeys(['optimized', 'kept', 'failed'], 0)
+        self.bytes_saved = 0
+        self._changed = set()  # blob names optimized since the last save
+
+    def submit(self, name):
+        """Optimize the blob ``name`` if not done yet, return the name of
+        its optimized version, relative to the source directory
+        """
+        target = optimized_name(name)
+        if name not in self._pending and not (name in self.images and
+                                              target in self.files):
+            self._pending[name] = self.pool.apply_async(optimize_image, (
+                os.path.join(self.source_dir, name), self.files.path(target),
+                self.max_size, self.quality))
+        self._collect()
+        return self.subdir + '/' + target
+
+    def _collect(self, wait=False):
+        """Record the finished optimizations, all of them with ``wait``"""
+        for name, result in list(self._pending.items()):
+            if not wait and not result.ready():
+                continue
+            del self._pending[name]
+            try:
+                status, original_size, size, elapsed = \
+                    result.get(WAIT_TIMEOUT)
+            except Exception as e:
+                print('Failed to optimize %s: %r' % (name, e))
+                self.counts['failed'] += 1
+                self.metrics.count(COUNTERS['failed'])
+                continue
+            target = optimized_name(name)
+            self.files.add(target)
+            self.images[name] = {'name': target, 'size': original_size,
+                                 'optimized_size': size, 'status': status}
+            self._changed.add(name)
+            self.counts[status] += 1
+            self.bytes_saved += original_size - size
+            self.metrics.add('optimize', elapsed)
+            self.metrics.count(COUNTERS[status])
+            self.metrics.count('image bytes saved', original_size - size)
+
+    def save(self):
+        if not self._changed:
+            return
+        # merged with the images the other processes saved
+        with file_lock(self.index):
+            saved = load_json(self.index)
+            if saved.get('settings') != self.settings:
+                saved = {'settings': self.settings, 'images': {}}
+            for name in merge_changes(self.images, saved['images'],
+                                      self._changed):
+                self.files.add(self.images[name]['name'])
+            atomic_write(self.index, json.dumps(saved, indent=1,
+                                                sort_keys=True))
+        self._changed.clear()
+
+    def report(self):
+        return ('Image optimizer: %(optimized)d optimized, %(kept)d kept as '
+                'they were, %(failed)d failed' % self.counts +
+                ', %.1f MB saved this run' % (self.bytes_saved / 1048576.0))
+
+    def close(self):
+        """Wait for all the images to be optimized"""
+        self._collect(wait=True)
+        self.pool.close()
+        self.pool.join()
+        self.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
+            self.save()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Per host scheduling of requests: rate limits, adaptive concurrency and
+circuit breaking."""
+import collections
+import threading
+import time
+import urlparse
+from multiprocessing import TimeoutError
+
+from scraper.fetch import WAIT_TIMEOUT
+
+
+class HostDown(IOError):
+    """Request not attempted: its host kept failing and was given up"""
+
+
+class Deferred(Exception):
+    """Raised by a request that cannot run yet: it is run again after
+    ``delay`` seconds, without counting as an attempt or a failure of its
+    host
+    """
+
+    def __init__(self, delay):
+        Exception.__init__(self, delay)
+        self.delay = delay
+
+
+class Task(object):
+    """A submitted request, waited for like an AsyncResult"""
+
+    def __init__(self, url, fn, errback):
+        self.url = url
+        self.fn = fn
+        self.errback = errback
+        self.attempts = 0
+        self.not_before = 0
+        self._event = threading.Event()
+        self._value = self._error = None
+
+    def ready(self):
+        return self._event.is_set()
+
+    def get(self, timeout=None):
+        """Return the value of the request, or of its errback if it failed
+        """
+        self._event.wait(timeout)
+        if not self._event.is_set():
+            raise TimeoutError('%s not done after %ss' % (self.url, timeout))
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _finish(self, value=None, error=None):
+        if error is not None:
+            if self.errback is None:
+                self._error = error
+            else:
+                try:
+                    value = self.errback(self.url, error)
+                except Exception as e:
+                    self._error = e
+        self._value = value
+        self._event.set()
+
+
+class _Host(object):
+    """Queue, rate limit and health of one host"""
+
+    def __init__(self, name, limit, tokens):
+        self.name = name
+        self.queue = collections.deque()
+        self.active = 0
+        self.limit = float(limit)  # adaptive concurrency
+        self.tokens = float(tokens)
+        self.refilled = time.time()
+        self.failures = 0  # consecutive
+        self.open_until = 0  # circuit open until then, then half open
+        self.trips = 0
+        self.down = False
+
+    def available(self, now):
+        """Whether requests to the host may be queued"""
+        return not self.down and self.open_until <= now
+
+    def error(self):
+        if self.down:
+            return HostDown('%s is down' % self.name)
+        return HostDown('%s is failing, circuit open' % self.name)
+
+
+class HostScheduler(object):
+    """Run requests in worker threads, with one queue per host
+
+    A worker takes the next request of the first host, in round robin
+    order, that is under its concurrency limit, has a token in its bucket
+    and is not circuit broken, so hosts that are slow or rate limited never
+    hold the workers the other hosts could use.
+
+    The concurrency of each host starts at ``initial_per_host`` and adapts
+    to what is observed: it grows by one per window of fast successes, up
+    to ``max_per_host``, and is halved on each failure or slow response.
+    After ``max_failures`` failures in a row the circuit of the host opens
+    for ``cooldown`` seconds (doubled each time): its requests fail at once
+    with HostDown, then a single probe is let through. A host whose circuit
+    opened more than ``max_trips`` times in a row is down for the rest of
+    the run.
+
+    ``fn(url)`` does the request. Exceptions of the ``transient`` classes
+    count as host failures and are retried ``num_retries`` times, later
+    and without holding a worker: not before their ``retry_after``
+    attribute, if they have one (the Retry-After of a 429 or 503), and not
+    at all when it is beyond ``max_retry_after`` seconds. Other exceptions
+    (a 404 means the host is fine) end the request, except Deferred. A
+    failed request gets the value of ``errback(url, error)``.
+
+    num_workers:
+        number of requests running at the same time, all hosts together
+    rate:
+        requests per second to each host, None for no limit
+    burst:
+        requests that can be made at once after an idle period
+    slow:
+        seconds above which a response counts as a failure of its host
+    """
+
+    def __init__(self, num_workers=8, rate=None, burst=4, initial_per_host=2,
+                 max_per_host=4, num_retries=2, retry_delay=1, slow=10,
+                 max_failures=5, cooldown=30, max_trips=3,
+                 transient=(IOError,), max_retry_after=300):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.initial_per_host = max(1, min(initial_per_host, max_per_host))
+        self.max_per_host = max(1, max_per_host)
+        self.num_retries = num_retries
+        self.retry_delay = retry_delay
+        self.slow = slow
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.transient = transient
+        self.max_retry_after = max_retry_after
+        self._cond = threading.Condition()
+        self._hosts = collections.OrderedDict()
+        self._cursor = 0
+        self._unfinished = 0
+        self._closing = self._terminated = False
+        self._threads = []
+        for i in range(max(1, num_workers)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, url, fn, errback=None):
+        """Queue ``fn(url)`` on the host of ``url``, return its Task"""
+        task = Task(url, fn, errback)
+        name = urlparse.urlsplit(url).netloc.lower()
+        with self._cond:
+            host = self._hosts.get(name)
+            if host is None:
+                host = self._hosts[name] = _Host(name, self.initial_per_host,
+                                                 self.burst)
+            available = host.available(time.time())
+            if available:
+                host.queue.append(task)
+                self._unfinished += 1
+                self._cond.notify()
+        if not available:
+            task._finish(error=host.error())
+        return task
+
+    def _next(self, now):
+        """Take the next runnable task, or return how long to wait before
+        one may be (None: until something happens)
+        """
+        hosts = list(self._hosts.values())
+        wait = None
+        for i in range(len(hosts)):
+            host = hosts[(self._cursor + i) % len(hosts)]
+            if not host.queue or host.active >= int(host.limit):
+                continue
+            if host.open_until and host.active:
+                # half open: one probe at a time
+                continue
+            task = host.queue[0]
+            if task.not_before > now:
+                wait = _earliest(wait, task.not_before - now)
+                continue
+            if self.rate:
+                host.tokens = min(self.burst, host.tokens +
+                                  (now - host.refilled) * self.rate)
+                host.refilled = now
+                if host.tokens < 1:
+                    wait = _earliest(wait, (1 - host.tokens) / self.rate)
+                    continue
+                host.tokens -= 1
+            host.queue.popleft()
+            host.active += 1
+            self._cursor = (self._cursor + i + 1) % len(hosts)
+            return task, host, None
+        return None, None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._terminated:
+                        return
+                    task, host, wait = self._next(time.time())
+                    if task is not None:
+                        break
+                    if self._closing and not self._unfinished:
+                        return
+                    self._cond.wait(wait)
+            start = time.time()
+            try:
+                value = task.fn(task.url)
+            except Exception as e:
+                self._done(task, host, time.time() - start, error=e)
+            else:
+                self._done(task, host, time.time() - start, value=value)
+
+    def _done(self, task, host, elapsed, value=None, error=None):
+        if isinstance(error, Deferred):
+            with self._cond:
+                host.active -= 1
+                task.not_before = time.time() + error.delay
+                host.queue.append(task)
+                self._cond.notify_all()
+            return
+        transient = error is not None and isinstance(error, self.transient)
+        healthy = not transient and elapsed < self.slow
+        delay = getattr(error, 'retry_after', None)
+        retry = False
+        abandoned = []
+        now = time.time()
+        with self._cond:
+            host.active -= 1
+            if healthy:
+                host.failures = host.trips = 0
+                host.open_until = 0
+                host.limit = min(self.max_per_host,
+                                 host.limit + 1.0 / host.limit)
+            elif host.open_until <= now:
+                # failures of requests started before the circuit opened
+                # do not count again
+                host.failures += 1
+                host.limit = max(1.0, host.limit / 2)
+                # a failed probe opens the circuit again at once
+                if host.open_until or host.failures >= self.max_failures:
+                    host.trips += 1
+                    if host.trips > self.max_trips:
+                        host.down = True
+                    else:
+                        host.open_until = now + (self.cooldown *
+                                                 2 ** (host.trips - 1))
+                    abandoned = list(host.queue)
+                    host.queue.clear()
+                    self._unfinished -= len(abandoned)
+            if transient and task.attempts < self.num_retries \
+                    and host.open_until <= now and not host.down \
+                    and (delay is None or delay <= self.max_retry_after):
+                retry = True
+                task.not_before = now + max(
+                    self.retry_delay * 2 ** task.attempts, delay or 0)
+                task.attempts += 1
+                host.queue.append(task)
+            else:
+                self._unfinished -= 1
+            self._cond.notify_all()
+        if not retry:
+            task._finish(value, error)
+        for other in abandoned:
+            other._finish(error=host.error())
+
+    def hosts_down(self):
+        with self._cond:
+            return [host.name for host in self._hosts.values() if host.down]
+
+    def close(self):
+        """Run the queued requests, then stop the workers"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(WAIT_TIMEOUT)
+
+    def terminate(self):
+        """Stop the workers, dropping the queued requests"""
+        with self._cond:
+            self._terminated = True
+            self._cond.notify_all()
+
+
+def _earliest(wait, delay):
+    return delay if wait is None else min(wait, delay)
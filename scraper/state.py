@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Checkpoints of each article through the scraping pipeline."""
+import sqlite3
+import time
+
+from scraper.utils import file_lock
+
+# stages in pipeline order, each recorded once the step is over
+FETCHED = 'fetched'
+EXTRACTED = 'extracted'
+IMAGES_DONE = 'images-done'
+CONVERTED = 'converted'
+WRITTEN = 'written'
+FAILED = 'failed'
+STAGES = [FETCHED, EXTRACTED, IMAGES_DONE, CONVERTED, WRITTEN, FAILED]
+
+
+class PipelineState(object):
+    """Stage reached by each article, in a SQLite database
+
+    Each article moves through FETCHED, EXTRACTED, IMAGES_DONE, CONVERTED
+    and WRITTEN, or ends FAILED with the step that failed ('fetch',
+    'extract', 'images', 'convert' or 'write') and the reason. An article is
+    only complete once WRITTEN with all its images: one written while some
+    of its images could not be downloaded, or stopped at any earlier stage
+    by a crash, is done again by the next run, while the failures can be
+    listed without going through the articles.
+
+    The database is in WAL mode unless ``wal`` is False, for a database on
+    a volume shared by several machines (WAL needs all the processes on the
+    same machine).
+
+    filename:
+        the SQLite database
+    wal:
+        use WAL mode
+    """
+
+    def __init__(self, filename='state.db', wal=True):
+        self.filename = filename
+        # one process at a time: a connection opened while another process
+        # creates the database fails with "database schema has changed"
+        with file_lock(filename):
+            self.conn = sqlite3.connect(filename, timeout=60,
+                                        isolation_level=None)
+            self.conn.text_factory = str
+            self.conn.execute('PRAGMA journal_mode=%s'
+                              % ('WAL' if wal else 'DELETE'))
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS articles (
+                    url TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    page_hash TEXT,
+                    filename TEXT,
+                    images_missing INTEGER NOT NULL DEFAULT 0,
+                    failed_step TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS articles_stage ON articles (stage);
+            """)
+
+    def __contains__(self, url):
+        return self.stage(url) is not None
+
+    def stage(self, url):
+        """Stage of ``url``, None if it was never started"""
+        row = self.conn.execute('SELECT stage FROM articles WHERE url=?',
+                                (url,)).fetchone()
+        return row and row[0]
+
+    def is_complete(self, url):
+        """Whether ``url`` was written with all its images"""
+        row = self.conn.execute(
+            'SELECT stage, images_missing FROM articles WHERE url=?',
+            (url,)).fetchone()
+        return row is not None and row[0] == WRITTEN and not row[1]
+
+    def unfinished(self):
+        """URLs of the articles started but not complete"""
+        return set(url for url, in self.conn.execute(
+            'SELECT url FROM articles WHERE stage!=? OR images_missing>0',
+            (WRITTEN,)))
+
+    def advance(self, url, stage, **fields):
+        """Record that ``url`` reached ``stage``
+
+        ``fields`` are the page_hash, filename or images_missing known at
+        that stage. Each FETCHED starts a new attempt.
+        """
+        now = time.time()
+        fields.update(stage=stage, failed_step=None, error=None, updated=now)
+        names = sorted(fields)
+        self._update(url, stage, ', '.join('%s=?' % name for name in names),
+                     [fields[name] for name in names], stage == FETCHED)
+
+    def fail(self, url, step, error):
+        """Record that ``step`` failed for ``url`` because of ``error``"""
+        self._update(url, FAILED,
+                     'stage=?, failed_step=?, error=?, updated=?',
+                     [FAILED, step, error, time.time()], step == 'fetch')
+
+    def _update(self, url, stage, assignments, values, new_attempt):
+        # the row is created by the first stage of the first attempt
+        self.conn.execute(
+            'INSERT OR IGNORE INTO articles (url, stage, updated, attempts) '
+            'VALUES (?, ?, ?, 0)', (url, stage, time.time()))
+        self.conn.execute(
+            'UPDATE articles SET %s, attempts=attempts+? WHERE url=?'
+            % assignments, values + [int(new_attempt), url])
+
+    def failures(self):
+        """(url, failed step, error, attempts) of the failed articles"""
+        return self.conn.execute(
+            'SELECT url, failed_step, error, attempts FROM articles '
+            'WHERE stage=? ORDER BY failed_step, url', (FAILED,)).fetchall()
+
+    def counts(self):
+        """Number of articles at each stage"""
+        counts = dict.fromkeys(STAGES, 0)
+        counts.update(self.conn.execute(
+            'SELECT stage, COUNT(*) FROM articles GROUP BY stage'))
+        return counts
+
+    def report(self):
+        counts = self.counts()
+        missing = self.conn.execute(
+            'SELECT COUNT(*) FROM articles WHERE stage=? AND '
+            'images_missing>0', (WRITTEN,)).fetchone()[0]
+        report = 'Articles: ' + ', '.join(
+            '%d %s' % (counts[stage], stage) for stage in STAGES
+            if counts[stage])
+        if missing:
+            report += ' (%d written with missing images)' % missing
+        return report
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Content addressed storage for the downloaded images."""
+import hashlib
+import imghdr
+import json
+import os
+import re
+import shutil
+import threading
+
+from scraper.dirindex import DirectoryIndex
+from scraper.utils import atomic_write, file_lock, load_json, merge_changes
+
+# imghdr types whose usual extension is not the type name
+EXTENSIONS = {'jpeg': '.jpg', 'tiff': '.tif'}
+
+_extension_regex = re.compile(r'^\.[a-z0-9]{1,5}$')
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def guess_extension(url, path):
+    """Extension from the content if it is a known image type, else from
+    the URL, else none
+    """
+    kind = imghdr.what(path)
+    if kind:
+        return EXTENSIONS.get(kind, '.' + kind)
+    ext = os.path.splitext(url.split('?', 1)[0])[1].lower()
+    if _extension_regex.match(ext):
+        return ext
+    return ''
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+class ImageStore(object):
+    """Images stored once per content, named after their sha1
+
+    An index maps each source URL to the name of its blob, so the same
+    picture found under several URLs is kept once, and a URL already in
+    the index is never downloaded again.
+
+    directory:
+        where the blobs are stored (the mirror of the assets site)
+    index:
+        JSON file holding the URL -> blob name index
+    validator_index:
+        JSON file holding the ETag and Last-Modified of each URL, used to
+        revalidate the images
+    save_every:
+        save after this many new URLs, so a crash loses little
+
+    Several processes can share the store: each save merges the index
+    files with the entries the others saved.
+    """
+
+    def __init__(self, directory='images', index='image_index.json',
+                 validator_index='image_validators.json', save_every=50):
+        self.directory = directory
+        self.index = index
+        self.validator_index = validator_index
+        self.save_every = save_every
+        self.files = DirectoryIndex(directory)
+        self._lock = threading.Lock()
+        self.urls = load_json(index)
+        self.validators = load_json(validator_index)
+        self._names = {}  # sha1 -> blob name
+        for name in self.urls.values():
+            self._names[name.split('.', 1)[0]] = name
+        self.num_duplicates = 0
+        # keys changed since the last save
+        self._changed_urls = set()
+        self._changed_validators = set()
+
+    def lookup(self, url):
+        """Return the blob name of ``url``, or None if not stored yet
+        """
+        return self.urls.get(url)
+
+    def add(self, url, path, validators=None):
+        """Move the file downloaded at ``path`` into the store as ``url``
+
+        Returns the blob name. If the same content is already stored the
+        file is simply removed. ``validators`` are the ETag and
+        Last-Modified of the response, if any.
+        """
+        return self._store(url, path, validators=validators)
+
+    def record(self, url, name):
+        """Register ``url`` as the blob ``name`` another process stored"""
+        with self._lock:
+            self._learn(url, name)
+            self._changed_urls.add(url)
+            self._changed()
+
+    def _learn(self, url, name):
+        self.urls[url] = name
+        self._names.setdefault(name.split('.', 1)[0], name)
+        self.files.add(name)
+
+    def adopt(self, url, path):
+        """Register a file downloaded before the store existed
+
+        The file is left in place (articles converted earlier still use
+        it) and hard linked, or copied, to its blob name.
+        """
+        return self._store(url, path, adopt=True)
+
+    def _store(self, url, path, adopt=False, validators=None):
+        digest = file_hash(path)
+        with self._lock:
+            name = self._names.get(digest)
+            if name is None:
+                name = digest + guess_extension(url, path)
+                self._names[digest] = name
+            else:
+                self.num_duplicates += 1
+            dest = os.path.join(self.directory, name)
+            if adopt:
+                if name not in self.files:
+                    _link_or_copy(path, dest)
+                    self.files.add(name)
+            elif name in self.files:
+                os.remove(path)
+            else:
+                os.rename(path, dest)
+                self.files.add(name)
+            self.urls[url] = name
+            self._changed_urls.add(url)
+            if validators:
+                self.validators[url] = validators
+                self._changed_validators.add(url)
+            self._changed()
+        return name
+
+    def _changed(self):
+        if len(self._changed_urls) >= self.save_every:
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if self._changed_urls:
+            with file_lock(self.index):
+                saved = load_json(self.index)
+                for url in merge_changes(self.urls, saved,
+                                         self._changed_urls):
+                    self._learn(url, self.urls[url])
+                atomic_write(self.index, json.dumps(saved, indent=1,
+                                                    sort_keys=True))
+            self._changed_urls.clear()
+        if self._changed_validators:
+            with file_lock(self.validator_index):
+                saved = load_json(self.validator_index)
+                merge_changes(self.validators, saved,
+                              self._changed_validators)
+                atomic_write(self.validator_index, json.dumps(
+                    saved, indent=1, sort_keys=True))
+            self._changed_validators.clear()
+
+    def report(self):
+        return ('Image store: %d URLs, %d blobs, %d duplicates found this run'
+                % (len(self.urls), len(self._names), self.num_duplicates))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Small file helpers shared by the scraper modules."""
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# read once at import: os.umask() can only be read by changing it, which is
+# not safe once threads are running
+UMASK = _umask()
+
+
+def mkstemp(dirname, prefix):
+    """tempfile.mkstemp, but with the permissions of a newly created file
+    instead of 0600
+    """
+    fd, path = tempfile.mkstemp(dir=dirname, prefix=prefix)
+    os.fchmod(fd, 0o666 & ~UMASK)
+    return fd, path
+
+
+def atomic_write(filename, data):
+    """Write ``data`` to ``filename`` so readers never see a partial file
+
+    The content goes to a temporary file in the same directory, which is
+    then renamed over ``filename``.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = mkstemp(dirname, '.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def load_json(filename):
+    """The JSON object saved in ``filename``, an empty dict if there is
+    none or it cannot be read
+    """
+    if os.path.exists(filename):
+        with open(filename) as f:
+            try:
+                return json.loads(f.read())
+            except ValueError:
+                pass
+    return {}
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """Hold the lock of ``filename`` against the other processes
+
+    The lock is a POSIX lock on ``<filename>.lock``, which NFS supports, so
+    it also holds between the machines sharing the directory.
+    """
+    with open(filename + '.lock', 'a') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def merge_changes(data, saved, changed):
+    """Merge the dicts ``data`` (in memory) and ``saved`` (read from the
+    file other processes also write)
+
+    The ``changed`` keys of ``data`` go into ``saved``, the other keys of
+    ``saved`` into ``data``. Returns the keys ``data`` got from ``saved``.
+    """
+    for key in changed:
+        saved[key] = data[key]
+    updated = [key for key, value in saved.items()
+               if key not in changed and data.get(key) != value]
+    for key in updated:
+        data[key] = saved[key]
+    return updated
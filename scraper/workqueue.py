@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Work queue shared by several scraper processes, in a SQLite database."""
+import contextlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from scraper.fetch import WAIT_TIMEOUT
+from scraper.utils import file_lock
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+# claim() only: another worker holds the lease
+BUSY = 'busy'
+
+
+class WorkQueue(object):
+    """URLs to process, divided between workers by leases
+
+    Each item (a URL of some kind: 'article', 'image'...) is pending, leased
+    by a worker, done or failed. A worker leases items for ``lease_time``
+    seconds; a heartbeat thread keeps extending the leases of the items it
+    holds, so when a worker crashes its items come back once their lease
+    expires, and are leased by another worker (or by the same one
+    restarted). Each lease counts as an attempt: an item is failed after
+    ``max_attempts``, whether its attempts failed or expired.
+
+    The database can be on a volume shared by several machines. WAL mode
+    needs all the processes on the same machine, so the default rollback
+    journal is kept unless ``wal`` is set.
+
+    filename:
+        the SQLite database
+    lease_time:
+        seconds a leased item stays with its worker without a heartbeat
+    max_attempts:
+        leases of an item before it is failed
+    worker:
+        name of this worker in the database, host and pid by default
+    """
+
+    def __init__(self, filename='queue.db', lease_time=300, max_attempts=3,
+                 worker=None, wal=False):
+        self.filename = filename
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.worker = worker or '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.wal = wal
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._held = set()  # (kind, url) leased by this worker
+        self._stopped = threading.Event()
+        # one process at a time: a connection opened while another process
+        # creates the database fails with "database schema has changed"
+        with file_lock(filename):
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    kind TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    lease_until REAL,
+                    result TEXT,
+                    error TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (kind, url)
+                );
+                CREATE INDEX IF NOT EXISTS items_state ON items (kind, state);
+            """)
+        self._heartbeat = threading.Thread(target=self._beat)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    @property
+    def conn(self):
+        """The connection of the current thread"""
+        try:
+            return self._local.conn
+        except AttributeError:
+            conn = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None)
+            conn.text_factory = str
+            if self.wal:
+                conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock at once, so two workers never
+        # select the same pending items
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def put(self, kind, urls):
+        """Add the ``urls`` not queued yet, return how many were added"""
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO items (kind, url, updated) '
+                'VALUES (?, ?, ?)', ((kind, url, now) for url in urls))
+            return conn.total_changes - before
+
+    def lease(self, kind, n=1):
+        """Lease up to ``n`` items of ``kind``, return their URLs"""
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire(conn, kind, now)
+            urls = [url for url, in conn.execute(
+                'SELECT url FROM items WHERE kind=? AND (state=? OR '
+                '(state=? AND lease_until<?)) ORDER BY rowid LIMIT ?',
+                (kind, PENDING, LEASED, now, n))]
+            conn.executemany(
+                'UPDATE items SET state=?, owner=?, lease_until=?, '
+                'attempts=attempts+1, updated=? WHERE kind=? AND url=?',
+                ((LEASED, self.worker, now + self.lease_time, now, kind, url)
+                 for url in urls))
+        with self._lock:
+            self._held.update((kind, url) for url in urls)
+        return urls
+
+    def claim(self, kind, url):
+        """Lease ``url``, adding it to the queue if needed
+
+        Returns ``(state, value)``: (LEASED, None) when this worker got the
+        lease, (BUSY, None) when another worker holds it, (DONE, result) or
+        (FAILED, error) when the item is finished.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO items (kind, url, updated) '
+                         'VALUES (?, ?, ?)', (kind, url, now))
+            self._expire(conn, kind, now)
+            state, owner, lease_until, result, error = conn.execute(
+                'SELECT state, owner, lease_until, result, error FROM items '
+                'WHERE kind=? AND url=?', (kind, url)).fetchone()
+            if state == DONE:
+                return DONE, result
+            if state == FAILED:
+                return FAILED, error
+            if state == LEASED and owner != self.worker \
+                    and lease_until >= now:
+                return BUSY, None
+            conn.execute(
+                'UPDATE items SET state=?, owner=?, lease_until=?, '
+                'attempts=attempts+1, updated=? WHERE kind=? AND url=?',
+                (LEASED, self.worker, now + self.lease_time, now, kind, url))
+        with self._lock:
+            self._held.add((kind, url))
+        return LEASED, None
+
+    def _expire(self, conn, kind, now):
+        # expired leases with no attempt left: the item keeps crashing or
+        # stalling its workers
+        conn.execute(
+            'UPDATE items SET state=?, owner=NULL, lease_until=NULL, '
+            'error=?, updated=? WHERE kind=? AND state=? AND lease_until<? '
+            'AND attempts>=?', (FAILED, 'lease expired', now, kind, LEASED,
+                                now, self.max_attempts))
+
+    def done(self, kind, url, result=None):
+        """Mark ``url`` done, with an optional ``result`` string"""
+        self.conn.execute(
+            'UPDATE items SET state=?, owner=NULL, lease_until=NULL, '
+            'result=?, error=NULL, updated=? WHERE kind=? AND url=?',
+            (DONE, result, time.time(), kind, url))
+        self._release(kind, url)
+
+    def fail(self, kind, url, error, retry=True):
+        """Record that the attempt at ``url`` failed with ``error``
+
+        With ``retry`` the item is pending again if it has attempts left.
+        """
+        self.conn.execute(
+            'UPDATE items SET state=CASE WHEN ? AND attempts<? THEN ? '
+            'ELSE ? END, owner=NULL, lease_until=NULL, error=?, updated=? '
+            'WHERE kind=? AND url=?',
+            (bool(retry), self.max_attempts, PENDING, FAILED, error,
+             time.time(), kind, url))
+        self._release(kind, url)
+
+    def retry_failed(self, kind):
+        """Make the failed items of ``kind`` pending again, with all their
+        attempts, return how many
+        """
+        return self.conn.execute(
+            'UPDATE items SET state=?, attempts=0, updated=? WHERE kind=? '
+            'AND state=?', (PENDING, time.time(), kind, FAILED)).rowcount
+
+    def _release(self, kind, url):
+        with self._lock:
+            self._held.discard((kind, url))
+
+    def release(self):
+        """Give back the items this worker holds, without counting their
+        attempt
+        """
+        with self._lock:
+            held = list(self._held)
+            self._held.clear()
+        with self._transaction() as conn:
+            conn.executemany(
+                'UPDATE items SET state=?, owner=NULL, lease_until=NULL, '
+                'attempts=attempts-1 WHERE kind=? AND url=? AND owner=? '
+                'AND state=?', ((PENDING, kind, url, self.worker, LEASED)
+                                for kind, url in held))
+
+    def _beat(self):
+        while not self._stopped.wait(self.lease_time / 3.0):
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            until = time.time() + self.lease_time
+            try:
+                with self._transaction() as conn:
+                    conn.executemany(
+                        'UPDATE items SET lease_until=? WHERE kind=? AND '
+                        'url=? AND owner=? AND state=?',
+                        ((until, kind, url, self.worker, LEASED)
+                         for kind, url in held))
+            except sqlite3.Error as e:
+                # the database may be busy for longer than the timeout,
+                # the next beat will do
+                print('Queue heartbeat failed: %s' % e)
+
+    def iter_leased(self, kind, batch=10):
+        """Lease and yield the items of ``kind``, ``batch`` at a time,
+        until none can be leased
+        """
+        while True:
+            urls = self.lease(kind, batch)
+            if not urls:
+                return
+            for url in urls:
+                yield url
+
+    def rounds(self, kind, batch=10, poll=5):
+        """Yield ``iter_leased()`` iterators, until no item of ``kind`` is
+        pending or leased by another worker
+
+        The next round starts when items can be leased again: while other
+        workers hold items, the queue is polled every ``poll`` seconds, as
+        their items come back if they crash. The items of a round must be
+        done or failed before asking for the next one, or two workers could
+        wait for each other's items.
+        """
+        while True:
+            yield self.iter_leased(kind, batch)
+            while True:
+                leasable, others = self._remaining(kind)
+                if leasable:
+                    break
+                if not others:
+                    return
+                time.sleep(poll)
+
+    def _remaining(self, kind):
+        """Number of items of ``kind`` that can be leased, and of items
+        leased by other workers
+        """
+        now = time.time()
+        return self.conn.execute(
+            'SELECT COALESCE(SUM(state=? OR lease_until<?), 0), '
+            'COALESCE(SUM(state=? AND lease_until>=? AND owner!=?), 0) '
+            'FROM items WHERE kind=? AND state IN (?, ?)',
+            (PENDING, now, LEASED, now, self.worker, kind, PENDING,
+             LEASED)).fetchone()
+
+    def counts(self, kind):
+        """Number of items of ``kind`` in each state"""
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        counts.update(self.conn.execute(
+            'SELECT state, COUNT(*) FROM items WHERE kind=? GROUP BY state',
+            (kind,)))
+        return counts
+
+    def report(self):
+        lines = []
+        for kind, in self.conn.execute(
+                'SELECT DISTINCT kind FROM items ORDER BY kind').fetchall():
+            counts = self.counts(kind)
+            lines.append('Queue %s: %d done, %d failed, %d pending, %d leased'
+                         % (kind, counts[DONE], counts[FAILED],
+                            counts[PENDING], counts[LEASED]))
+        return '\n'.join(lines)
+
+    def close(self):
+        """Stop the heartbeat and give back the items still held"""
+        self._stopped.set()
+        self._heartbeat.join(WAIT_TIMEOUT)
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()